@@ -0,0 +1,131 @@
+from functools import lru_cache
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """
+    Настройки сервиса из переменных окружения и .env.
+    Читаются один раз, отсутствие обязательных переменных роняет старт приложения
+    """
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
+
+    APP_HOST: str = "0.0.0.0"
+    APP_PORT: int = 8000
+
+    DATABASE_URL: str
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    # БД-шарды для таблиц по user_id (models.SHARDED_TABLES), JSON-список URL. Пусто - все в DATABASE_URL.
+    # Шард - user_id % число шардов: менять число шардов можно только с переносом данных
+    DATABASE_SHARD_URLS: list[str] = []
+
+    SECRET_KEY: str
+    ALGORITHM: str = "HS256"
+
+    AUTH_SERVER: str
+    QRCODES_PATH: str
+    FILES_PATH: str = "files"
+    FILES_MAX_SIZE: int = 50 * 1024 * 1024
+    # Токен сервиса загрузки файлов
+    ADMIN: str
+    # Общий ключ Telegram-бота
+    KOSTYA: str
+
+    # Неверных попыток ввода кода до блокировки
+    CODE_MAX_ATTEMPTS: int = 5
+    # Дублировать счетчики попыток в verification_codes.attempts (несколько воркеров)
+    CODE_ATTEMPTS_PERSIST: bool = False
+
+    LOG_LEVEL: str = "INFO"
+    # Доля логируемых запросов по имени endpoint, остальные - 1.0
+    LOG_SAMPLE_RATES: dict[str, float] = {"change_token": 0.1, "qr_longpoll": 0.1}
+
+    # Bloom-фильтр зарегистрированных контактов и LRU активных пользователей перед get_user_by_*
+    IDENTITY_CACHE_ENABLED: bool = True
+    IDENTITY_BLOOM_CAPACITY: int = 1_000_000
+    IDENTITY_CACHE_SIZE: int = 100_000
+    IDENTITY_REFRESH_SECONDS: float = 5.0
+    # Догрузка перечитывает столько последних id: строки, закоммиченные после строк с большим id
+    IDENTITY_REFRESH_OVERLAP_IDS: int = 1000
+
+    # Поиск блокировок event loop и выборочное профилирование, отчет в /api/diagnostics
+    DIAGNOSTICS_ENABLED: bool = False
+    DIAGNOSTICS_LOOP_LAG_MS: int = 100
+    DIAGNOSTICS_PROFILE_SAMPLE_RATE: float = 0.0
+    DIAGNOSTICS_SLOW_REQUEST_MS: int = 500
+
+    # Доставка кодов через outbox. OUTBOX_WORKERS=0 - воркеры запускаются отдельно: python -m src.outbox
+    OUTBOX_WORKERS: int = 2
+    OUTBOX_BATCH_SIZE: int = 100
+    OUTBOX_POLL_SECONDS: float = 1.0
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_BACKOFF_SECONDS: float = 2.0
+    # Захваченная пачка отправляется без транзакции; не отчитавшийся за OUTBOX_LEASE_SECONDS воркер считается упавшим.
+    # Отправленные и просроченные сообщения удаляются через OUTBOX_RETENTION_HOURS
+    OUTBOX_LEASE_SECONDS: float = 120.0
+    OUTBOX_RETENTION_HOURS: float = 24.0
+
+    # Журнал входов: события копятся в памяти и пишутся пачкой по размеру либо по времени.
+    # При недоступной БД в памяти держится не больше AUDIT_MAX_PENDING событий
+    AUDIT_ENABLED: bool = True
+    AUDIT_BATCH_SIZE: int = 500
+    AUDIT_FLUSH_SECONDS: float = 1.0
+    AUDIT_MAX_PENDING: int = 100_000
+
+    # Admission control (src.admission): лимит одновременных запросов и ожидание места в очереди (мс) по классам.
+    # Класс endpoint - по ADMISSION_ENDPOINT_CLASSES, остальные - default, класс без лимита не ограничивается.
+    # Классы ADMISSION_SHED_CLASSES отклоняются сразу, если сглаженный лаг event loop выше ADMISSION_LOOP_LAG_MS
+    # либо выдана доля ADMISSION_POOL_USAGE соединений пула БД
+    ADMISSION_ENABLED: bool = True
+    # Ожидающий longpoll не держит соединение БД, опросы всех ожидающих делят service.QR_POLL_CONNECTIONS соединений:
+    # 1000 ожидающих - около 1000 коротких SELECT в секунду
+    ADMISSION_LIMITS: dict[str, int] = {"critical": 200, "default": 100, "low": 50, "longpoll": 1000}
+    ADMISSION_QUEUE_MS: dict[str, int] = {"critical": 2000, "default": 1000, "low": 100, "longpoll": 0}
+    ADMISSION_ENDPOINT_CLASSES: dict[str, str] = {
+        "change_token": "critical",
+        "auth_confirm_phone": "critical",
+        "auth_confirm_email": "critical",
+        "registration_confirm_phone": "critical",
+        "registration_confirm_email": "critical",
+        "auth_telegram_confirm_phone": "critical",
+        "auth_telegram_confirm_email": "critical",
+        "auth_telegram_login": "critical",
+        "registration_by_phone": "low",
+        "auth_get_code_by_phone": "low",
+        "auth_get_code_by_email": "low",
+        "auth_telegram_get_code_phone": "low",
+        "auth_telegram_get_code_email": "low",
+        "auth_qr_get_code": "low",
+        "export_users": "low",
+        "qr_longpoll": "longpoll",
+    }
+    ADMISSION_SHED_CLASSES: list[str] = ["low", "longpoll"]
+    ADMISSION_LOOP_LAG_MS: int = 50
+    ADMISSION_POOL_USAGE: float = 0.9
+    ADMISSION_RETRY_AFTER_SECONDS: int = 1
+
+    # SMS-провайдер с JSON API sms.SMSClient.HTTPSMSClient, без SMS_PROVIDER_URL - заглушка.
+    # SMS_BATCH_SIZE=1, если провайдер не принимает несколько сообщений в одном запросе
+    SMS_PROVIDER_URL: Optional[str] = None
+    SMS_API_KEY: Optional[str] = None
+    SMS_SENDER: Optional[str] = None
+    SMS_BATCH_SIZE: int = 100
+    SMS_CONCURRENCY: int = 4
+    SMS_TIMEOUT_SECONDS: float = 10.0
+
+    # Без SMTP_HOST письма уходят в заглушку mail.MailClient.StubSMTPClient
+    SMTP_HOST: Optional[str] = None
+    SMTP_PORT: Optional[int] = None
+    SMTP_USER: Optional[str] = None
+    SMTP_PASSWORD: Optional[str] = None
+    # Таймаут соединения и каждой операции SMTP: зависший сервер не держит поток отправки
+    SMTP_TIMEOUT_SECONDS: float = 30.0
+    # Адрес отправителя, по умолчанию SMTP_USER
+    SMTP_FROM: Optional[str] = None
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
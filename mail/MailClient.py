@@ -4,6 +4,7 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 import os
+from collections import deque
 from http.client import HTTPException
 
 
@@ -18,8 +19,23 @@ class BaseSMTPClient:
     3. Получить пароль от gmail
     4. Вставить этот пароль в .env
     """
-    def __init__(self):
+    def __init__(self, timeout: float = 30.0):
         self.server = None
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls, settings) -> "BaseSMTPClient":
+        """
+            Создает подключенный клиент по настройкам SMTP_* (config.Settings).
+            Незаданные host/port берутся по умолчанию из connect
+            """
+        client = cls(timeout=settings.SMTP_TIMEOUT_SECONDS)
+        address = {key: value for key, value in (("host", settings.SMTP_HOST), ("port", settings.SMTP_PORT))
+                   if value is not None}
+        client.connect(**address)
+        if settings.SMTP_USER:
+            client.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+        return client
 
     def connect(self, host: str, port: int) -> None:
         raise NotImplementedError("Not implemented this")
@@ -68,13 +84,32 @@ class BaseSMTPClient:
 
 class SMTPSSLClient(BaseSMTPClient):
     def connect(self, host: str = 'smtp.gmail.com', port: int = 465) -> None:
-        self.server = smtplib.SMTP_SSL(host, port)
+        self.server = smtplib.SMTP_SSL(host, port, timeout=self.timeout)
         self.server.ehlo()
 
 
 class SMTPTLSClient(BaseSMTPClient):
     def connect(self, host: str = 'smtp.gmail.com', port: int = 587) -> None:
-        self.server = smtplib.SMTP(host, port)
+        self.server = smtplib.SMTP(host, port, timeout=self.timeout)
         self.server.starttls()
         self.server.ehlo()
 
+
+class StubSMTPServer:
+    """Подменяет smtplib-сервер: письма складываются в messages, сеть не используется"""
+    messages: deque = deque(maxlen=1000)
+
+    def login(self, username, password):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.messages.append((from_addr, to_addrs, msg))
+
+    def quit(self):
+        pass
+
+
+class StubSMTPClient(BaseSMTPClient):
+    """Заглушка для локального запуска и тестов, отправленные письма - StubSMTPServer.messages"""
+    def connect(self, host: str = 'localhost', port: int = 25) -> None:
+        self.server = StubSMTPServer()
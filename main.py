@@ -1,34 +1,63 @@
 import contextlib
-import os
 from typing import AsyncIterator
 
 import uvicorn
-from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
 
 import orm
+from config import get_settings
 from orm import get_session
-from src.models import Role
+from src import admission, audit, diagnostics, identity, log, outbox, rbac
+from src.models import Role, SHARDED_TABLES
 from src.router import router
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
-    load_dotenv()
-    orm.db_manager.init(os.getenv("DATABASE_URL"))
+    settings = get_settings()
+    log.setup_logging(settings.LOG_LEVEL)
+    orm.db_manager.init(settings.DATABASE_URL, settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+    log.instrument_engine(orm.db_manager.engine)
     await orm.db_manager.init_db()
+    orm.shard_router.init(settings.DATABASE_SHARD_URLS, settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+    await orm.shard_router.init_db(SHARDED_TABLES)
     await Role.create_or_ignore(1, "user")
+    await rbac.load()
+    if settings.IDENTITY_CACHE_ENABLED:
+        await identity.init(settings.IDENTITY_BLOOM_CAPACITY,
+                            settings.IDENTITY_CACHE_SIZE,
+                            settings.IDENTITY_REFRESH_SECONDS,
+                            settings.IDENTITY_REFRESH_OVERLAP_IDS)
+    if settings.DIAGNOSTICS_ENABLED:
+        diagnostics.enable(settings.DIAGNOSTICS_LOOP_LAG_MS / 1000,
+                           settings.DIAGNOSTICS_PROFILE_SAMPLE_RATE,
+                           settings.DIAGNOSTICS_SLOW_REQUEST_MS / 1000)
+    if settings.OUTBOX_WORKERS:
+        outbox.start(settings)
+    if settings.AUDIT_ENABLED:
+        audit.init(settings.AUDIT_BATCH_SIZE, settings.AUDIT_FLUSH_SECONDS, settings.AUDIT_MAX_PENDING)
+    if settings.ADMISSION_ENABLED:
+        admission.enable(settings, orm.db_manager.engine)
     yield
+    await admission.disable()
+    await outbox.stop()
+    await audit.close()
+    await diagnostics.disable()
+    await identity.close()
+    await orm.shard_router.close()
     await orm.db_manager.close()
+    log.shutdown_logging()
 
 
-app = FastAPI(title="E-notGPT. Авторизация.", lifespan=lifespan)
+app = FastAPI(title="E-notGPT. Авторизация.", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(router, prefix="/api")
 
 
+# Внутри CORS: ответы 503 admission control тоже получают CORS-заголовки
+app.add_middleware(admission.AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,19 +65,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(diagnostics.DiagnosticsMiddleware)
+app.add_middleware(log.RequestLogMiddleware)
 
 
 @app.exception_handler(HTTPException)
 async def unicorn_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"status": False, "error": exc.detail},
     )
 
 if __name__ == "__main__":
-    load_dotenv()
+    settings = get_settings()
     uvicorn.run(
         app,
-        host=os.getenv("APP_HOST"),
-        port=int(os.getenv("APP_PORT"))
+        host=settings.APP_HOST,
+        port=settings.APP_PORT
     )
\ No newline at end of file
@@ -1,5 +1,6 @@
 from .session_manager import get_session, db_manager
+from .shard_router import shard_router
 from .base_model import OrmBase
 
 
-__all__ = ["OrmBase", "get_session", "db_manager"]
+__all__ = ["OrmBase", "get_session", "db_manager", "shard_router"]
@@ -22,7 +22,7 @@ class DatabaseSessionManager:
         self._engine: Optional[AsyncEngine] = None
         self._sessionmaker: Optional[async_sessionmaker[AsyncSession]] = None
 
-    def init(self, db_url: str) -> None:
+    def init(self, db_url: str, pool_size: int = 5, max_overflow: int = 10) -> None:
         # Just additional example of customization.
         # you can add parameters to init and so on
         if "postgresql" in db_url:
@@ -32,22 +32,34 @@ class DatabaseSessionManager:
                 "statement_cache_size": 0,
                 "prepared_statement_cache_size": 0,
             }
+            pool_args = {
+                "pool_size": pool_size,
+                "max_overflow": max_overflow,
+            }
         else:
             connect_args = {}
+            pool_args = {}
         self._engine = create_async_engine(
             url=db_url,
             pool_pre_ping=True,
             connect_args=connect_args,
+            **pool_args,
         )
         self._sessionmaker = async_sessionmaker(
             bind=self._engine,
             expire_on_commit=False,
         )
 
-    async def init_db(self) -> None:
-        async with db_manager.connect() as connection:
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is None:
+            raise IOError("DatabaseSessionManager is not initialized")
+        return self._engine
+
+    async def init_db(self, tables: Optional[list] = None) -> None:
+        async with self.connect() as connection:
             #await connection.run_sync(OrmBase.metadata.drop_all)
-            await connection.run_sync(OrmBase.metadata.create_all)
+            await connection.run_sync(OrmBase.metadata.create_all, tables=tables)
 
     async def close(self) -> None:
         if self._engine is None:
@@ -0,0 +1,115 @@
+import contextlib
+from typing import AsyncIterator, Callable, Iterable, Optional, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .session_manager import DatabaseSessionManager, db_manager
+
+T = TypeVar("T")
+
+# id строки в шарде - int4, номер шарда хранится в старших битах id, который видит клиент (code_id).
+# У шарда 0 id не меняются: без шардов code_id совпадает с id в основной БД
+SHARD_ID_SHIFT = 32
+
+
+class ShardRouter:
+    """
+    Маршрутизация таблиц с ключом user_id (models.SHARDED_TABLES) по нескольким БД.
+    Шард пользователя - user_id % число шардов. Без шардов единственный шард - основная БД db_manager.
+    Строку, которую ищут без user_id, находят по номеру шарда в ее внешнем id: global_id / split_id
+    для кодов подтверждения, префикс refresh токена (utils.refresh_token_shard)
+    """
+    def __init__(self) -> None:
+        self._shards: list[DatabaseSessionManager] = []
+
+    def init(self, db_urls: list[str], pool_size: int = 5, max_overflow: int = 10) -> None:
+        self._shards = []
+        for db_url in db_urls:
+            shard = DatabaseSessionManager()
+            shard.init(db_url, pool_size, max_overflow)
+            self._shards.append(shard)
+
+    @property
+    def shards(self) -> list[DatabaseSessionManager]:
+        return self._shards or [db_manager]
+
+    @property
+    def sharded(self) -> bool:
+        """Шарды заданы: шардируемые таблицы не в основной БД"""
+        return bool(self._shards)
+
+    def has_shard(self, shard_id: int) -> bool:
+        return 0 <= shard_id < len(self.shards)
+
+    def is_main(self, shard_id: Optional[int]) -> bool:
+        """Шард - основная БД: с users можно работать в одном запросе"""
+        return shard_id is None or self.shards[shard_id] is db_manager
+
+    def shard_id_for_user(self, user_id: int) -> int:
+        return user_id % len(self.shards)
+
+    def for_user(self, user_id: int) -> DatabaseSessionManager:
+        return self.shards[self.shard_id_for_user(user_id)]
+
+    @staticmethod
+    def global_id(shard_id: int, local_id: int) -> int:
+        """Внешний id строки шарда"""
+        return shard_id << SHARD_ID_SHIFT | local_id
+
+    @staticmethod
+    def split_id(global_id: int) -> tuple[int, int]:
+        """:return: (номер шарда, id строки в шарде)"""
+        return global_id >> SHARD_ID_SHIFT, global_id & ((1 << SHARD_ID_SHIFT) - 1)
+
+    def split_ids(self, global_ids: Iterable[int]) -> dict[int, list[int]]:
+        """Раскладывает внешние id по шардам: {shard_id: [local_id, ...]}. id несуществующих шардов пропускаются"""
+        partitions: dict[int, list[int]] = {}
+        for global_id in global_ids:
+            shard_id, local_id = self.split_id(global_id)
+            if self.has_shard(shard_id):
+                partitions.setdefault(shard_id, []).append(local_id)
+        return partitions
+
+    @contextlib.asynccontextmanager
+    async def session(self, shard_id: Optional[int], db: Optional[AsyncSession] = None
+                      ) -> AsyncIterator[AsyncSession]:
+        """
+        Сессия шарда. Если шард - основная БД и передана сессия вызывающего db, работа идет в ней
+        и коммит остается на вызывающем. Отдельная сессия шарда коммитится при выходе без исключения
+        :param shard_id: None - основная БД
+        :param db: сессия основной БД вызывающего
+        :return:
+        """
+        if db is not None and self.is_main(shard_id):
+            yield db
+            return
+        manager = db_manager if shard_id is None else self.shards[shard_id]
+        async with manager.session() as session:
+            yield session
+            await session.commit()
+
+    @contextlib.asynccontextmanager
+    async def session_for_user(self, user_id: int, db: Optional[AsyncSession] = None
+                               ) -> AsyncIterator[AsyncSession]:
+        async with self.session(self.shard_id_for_user(user_id), db) as session:
+            yield session
+
+    def partition(self, items: Iterable[T], user_id: Callable[[T], int]) -> dict[int, list[T]]:
+        """Раскладывает элементы по шардам: {shard_id: [item, ...]}"""
+        partitions: dict[int, list[T]] = {}
+        for item in items:
+            partitions.setdefault(self.shard_id_for_user(user_id(item)), []).append(item)
+        return partitions
+
+    async def init_db(self, tables: list) -> None:
+        """Создает шардируемые таблицы в шардах. Основная БД создается db_manager.init_db"""
+        for shard in self._shards:
+            await shard.init_db(tables)
+
+    async def close(self) -> None:
+        for shard in self._shards:
+            await shard.close()
+        self._shards = []
+
+
+shard_router = ShardRouter()
@@ -0,0 +1,76 @@
+"""
+Микробенчмарк сериализации ответов AuthOutput, UserOutput и GetQROutput:
+- stdlib_json - прежний путь: model_dump(mode="json") и JSONResponse на stdlib json;
+- fastapi_default - модель через штатный путь FastAPI с response_model (serialize_response) и ORJSONResponse;
+- model_dump_json - router.ModelResponseRoute: один проход model_dump_json.
+Запуск: python -m scripts.bench_serialization --number 100000
+"""
+import argparse
+import asyncio
+import time
+from datetime import date
+
+import orjson
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute, serialize_response
+from pydantic import BaseModel
+from starlette.responses import JSONResponse, Response
+
+from src.schemas import AuthOutput, GetQROutput, UserOutput
+
+TOKEN = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9." + "x" * 160 + ".signature-signature-signature-signatur"
+
+SAMPLES: dict[str, BaseModel] = {
+    "AuthOutput": AuthOutput(access_token=TOKEN, refresh_token="r" * 64),
+    "UserOutput": UserOutput(id=123456, first_name="Иван", last_name="Петров", middle_name="Сергеевич", gender=1,
+                             email="ivan.petrov@example.com", phone_number="79491234567",
+                             birth_date=date(1990, 5, 17)),
+    "GetQROutput": GetQROutput(token="a" * 64, url="https://auth.example.com/api/qr_code/auth/" + "a" * 64),
+}
+
+
+def response_field(model: type[BaseModel]):
+    """Поле ответа, которое FastAPI строит для response_model"""
+    route = APIRoute("/", endpoint=lambda: None, response_model=model)
+    return route.secure_cloned_response_field or route.response_field
+
+
+def paths(model: BaseModel) -> dict:
+    field = response_field(type(model))
+
+    async def stdlib_json() -> bytes:
+        return JSONResponse(model.model_dump(mode="json")).body
+
+    async def fastapi_default() -> bytes:
+        return ORJSONResponse(await serialize_response(field=field, response_content=model)).body
+
+    async def model_dump_json() -> bytes:
+        return Response(model.model_dump_json(), media_type="application/json").body
+
+    return {"stdlib_json": stdlib_json, "fastapi_default": fastapi_default, "model_dump_json": model_dump_json}
+
+
+async def measure(path, number: int) -> float:
+    """:return: микросекунд на ответ"""
+    started = time.perf_counter()
+    for _ in range(number):
+        await path()
+    return (time.perf_counter() - started) / number * 1_000_000
+
+
+async def main(number: int) -> None:
+    print(f"{'model':<12} {'path':<16} {'us/op':>8} {'speedup':>8}")
+    for name, model in SAMPLES.items():
+        model_paths = paths(model)
+        bodies = {orjson.dumps(orjson.loads(await path())) for path in model_paths.values()}
+        assert len(bodies) == 1, f"{name}: serialization paths disagree"
+        results = {path_name: await measure(path, number) for path_name, path in model_paths.items()}
+        for path_name, elapsed in results.items():
+            print(f"{name:<12} {path_name:<16} {elapsed:>8.2f} {results['stdlib_json'] / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100_000, help="ответов на каждый путь")
+    args = parser.parse_args()
+    asyncio.run(main(args.number))
@@ -0,0 +1,101 @@
+"""
+Проверка гонки подтверждения кода (service.consume_verification_code): concurrency параллельных
+auth_confirm одного кода на отдельных соединениях. Успешен ровно один, выдан ровно один refresh токен.
+Запуск на PostgreSQL: DATABASE_URL=postgresql+asyncpg://... python -m scripts.confirm_race --concurrency 50 --rounds 20
+Каждый раунд создает пользователя с новым номером и код, после проверки удаляет их
+"""
+import argparse
+import asyncio
+import secrets
+import sys
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select
+
+from config import get_settings
+from orm import db_manager
+from src import service
+from src.models import RefreshToken, User, VerificationCode
+from src.schemas import AuthConfirmPhone
+
+
+async def create_code() -> tuple[int, AuthConfirmPhone]:
+    phone_number = "7999" + "".join(str(secrets.randbelow(10)) for _ in range(7))
+    async with db_manager.session() as db:
+        user = User(first_name="Race", last_name="Check", phone_number=phone_number, is_active=True,
+                    created_at=datetime.utcnow())
+        db.add(user)
+        await db.flush()
+        code = VerificationCode(user_id=user.id, verification_type=service.VERIFICATION_TYPES["auth_phone"],
+                                code=service.code_generator(),
+                                expires_at=datetime.utcnow() + service.VERIFICATION_CODE_LIFETIME)
+        db.add(code)
+        await db.commit()
+        return user.id, AuthConfirmPhone(phone_number=phone_number, code_id=code.id, code=code.code)
+
+
+async def cleanup(user_id: int) -> None:
+    async with db_manager.session() as db:
+        await db.execute(delete(RefreshToken).where(RefreshToken.user_id == user_id))
+        await db.execute(delete(VerificationCode).where(VerificationCode.user_id == user_id))
+        await db.execute(delete(User).where(User.id == user_id))
+        await db.commit()
+
+
+async def confirm(start: asyncio.Event, data: AuthConfirmPhone) -> bool:
+    async with db_manager.session() as db:
+        # Соединение берется до старта, чтобы все UPDATE пришли в БД одновременно
+        await db.connection()
+        await start.wait()
+        try:
+            await service.auth_confirm(db, data)
+        except HTTPException:
+            return False
+        return True
+
+
+async def run_round(concurrency: int) -> tuple[int, int, list[BaseException]]:
+    user_id, data = await create_code()
+    try:
+        start = asyncio.Event()
+        tasks = [asyncio.create_task(confirm(start, data)) for _ in range(concurrency)]
+        # Все задачи держат соединение и ждут старта
+        await asyncio.sleep(0.5)
+        start.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async with db_manager.session() as db:
+            tokens = await db.scalar(select(func.count()).select_from(RefreshToken)
+                                     .where(RefreshToken.user_id == user_id))
+    finally:
+        await cleanup(user_id)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    return sum(result is True for result in results), tokens, errors
+
+
+async def main(concurrency: int, rounds: int) -> int:
+    settings = get_settings()
+    db_manager.init(settings.DATABASE_URL, pool_size=concurrency + 1, max_overflow=0)
+    await db_manager.init_db()
+    failed = 0
+    try:
+        for number in range(1, rounds + 1):
+            successes, tokens, errors = await run_round(concurrency)
+            ok = successes == 1 and tokens == 1 and not errors
+            failed += not ok
+            print(f"round {number}: {successes} confirmed, {tokens} refresh tokens, {len(errors)} errors"
+                  f" - {'ok' if ok else 'FAIL'}")
+            for error in errors[:3]:
+                print(f"  {error!r}")
+    finally:
+        await db_manager.close()
+    print(f"{rounds - failed}/{rounds} rounds issued exactly one token pair")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50, help="параллельных подтверждений одного кода")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.concurrency, args.rounds)))
@@ -0,0 +1,74 @@
+"""
+Отчет о времени импорта приложения в стиле python -X importtime: импортирует main в отдельном
+интерпретаторе и печатает общее время и самые долгие модули по cumulative.
+Код возврата 1, если при старте загружен модуль из LAZY_MODULES (они нужны только для изображений QR,
+src.qr_image) либо общее время больше --max-ms. Для CI:
+python -m scripts.importtime --top 20 --max-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import NamedTuple
+
+TARGET = "main"
+LAZY_MODULES = ("PIL", "qrcode_styled", "requests_async", "src.qr_image")
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse(stderr: str) -> list[ImportTime]:
+    """Строки вида 'import time:       214 |        305 |   encodings.aliases'"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|", 2)
+        rows.append(ImportTime(name.strip(), int(self_us), int(cumulative_us),
+                               (len(name) - len(name.lstrip()) - 1) // 2))
+    return rows
+
+
+def measure(target: str) -> list[ImportTime]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {target}"],
+                            capture_output=True, text=True, env=os.environ | {"PYTHONDONTWRITEBYTECODE": "1"})
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr[-4000:])
+        raise SystemExit(f"import {target} failed")
+    return parse(result.stderr)
+
+
+def main(target: str, top: int, max_ms: float) -> int:
+    rows = measure(target)
+    # Верхний уровень - сам target и модули старта интерпретатора (site, encodings)
+    total_ms = next((row.cumulative_us for row in rows if row.depth == 0 and row.module == target), 0) / 1000
+    startup_ms = sum(row.cumulative_us for row in rows if row.depth == 0) / 1000
+    print(f"import {target}: {total_ms:.1f} ms, with interpreter startup {startup_ms:.1f} ms, {len(rows)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for row in sorted(rows, key=lambda row: row.cumulative_us, reverse=True)[:top]:
+        print(f"{row.cumulative_us / 1000:>14.1f} {row.self_us / 1000:>9.1f}  {row.module}")
+
+    failed = False
+    eager = sorted({row.module for row in rows
+                    if any(row.module == lazy or row.module.startswith(lazy + ".") for lazy in LAZY_MODULES)})
+    if eager:
+        print(f"FAIL: imported at startup, must stay lazy: {', '.join(eager)}")
+        failed = True
+    if max_ms and total_ms > max_ms:
+        print(f"FAIL: import time {total_ms:.1f} ms exceeds {max_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", default=TARGET, help="импортируемый модуль")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=0.0, help="порог общего времени, 0 - без порога")
+    args = parser.parse_args()
+    sys.exit(main(args.target, args.top, args.max_ms))
@@ -0,0 +1,76 @@
+import asyncio
+from collections import deque
+from typing import Optional
+
+import httpx
+
+
+class BaseSMSClient:
+    """
+    Отправка SMS. send_many принимает пачку (телефон, текст) и возвращает ошибку
+    по каждому сообщению в том же порядке, None - принято провайдером
+    """
+    async def send_many(self, messages: list[tuple[str, str]]) -> list[Optional[str]]:
+        raise NotImplementedError("Not implemented this")
+
+    async def aclose(self) -> None:
+        pass
+
+
+class HTTPSMSClient(BaseSMSClient):
+    """
+    Провайдер с JSON API:
+    POST {url} {"sender": ..., "messages": [{"to": "7949...", "text": "..."}, ...]}
+    ответ {"results": [{"status": "ok"} | {"error": "..."}, ...]} в порядке messages.
+    Если провайдер принимает одно сообщение на запрос - batch_size=1.
+    Соединения берутся из пула httpx, одновременных запросов к провайдеру не больше concurrency
+    """
+    def __init__(self, url: str, api_key: Optional[str] = None, sender: Optional[str] = None,
+                 batch_size: int = 100, concurrency: int = 4, timeout: float = 10.0):
+        self.url = url
+        self.sender = sender
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
+        self._client = httpx.AsyncClient(headers=headers, timeout=timeout,
+                                         limits=httpx.Limits(max_connections=concurrency,
+                                                             max_keepalive_connections=concurrency))
+
+    @classmethod
+    def from_settings(cls, settings) -> "HTTPSMSClient":
+        """Клиент по настройкам SMS_* (config.Settings)"""
+        return cls(settings.SMS_PROVIDER_URL, api_key=settings.SMS_API_KEY, sender=settings.SMS_SENDER,
+                   batch_size=settings.SMS_BATCH_SIZE, concurrency=settings.SMS_CONCURRENCY,
+                   timeout=settings.SMS_TIMEOUT_SECONDS)
+
+    async def send_many(self, messages: list[tuple[str, str]]) -> list[Optional[str]]:
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        results = await asyncio.gather(*(self._send_batch(batch) for batch in batches))
+        return [error for batch in results for error in batch]
+
+    async def _send_batch(self, messages: list[tuple[str, str]]) -> list[Optional[str]]:
+        payload = {"sender": self.sender,
+                   "messages": [{"to": phone_number, "text": text} for phone_number, text in messages]}
+        async with self._semaphore:
+            try:
+                response = await self._client.post(self.url, json=payload)
+                response.raise_for_status()
+                results = response.json()["results"]
+            except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+                return [repr(e)] * len(messages)
+        if len(results) != len(messages):
+            return [f"Provider returned {len(results)} results for {len(messages)} messages"] * len(messages)
+        return [None if result.get("status") == "ok" else str(result.get("error", result)) for result in results]
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+class StubSMSClient(BaseSMSClient):
+    """Заглушка для локального запуска и тестов: сеть не используется, сообщения в messages"""
+    def __init__(self, maxlen: int = 1000):
+        self.messages: deque[tuple[str, str]] = deque(maxlen=maxlen)
+
+    async def send_many(self, messages: list[tuple[str, str]]) -> list[Optional[str]]:
+        self.messages.extend(messages)
+        return [None] * len(messages)
@@ -0,0 +1,84 @@
+"""
+Локальный SMS-провайдер с API HTTPSMSClient для тестов и замеров пропускной способности доставки кодов.
+Запуск: python -m sms.fake_server --port 9000 --latency-ms 50 --fail-rate 0.01
+и SMS_PROVIDER_URL=http://127.0.0.1:9000/send. Счетчики и сообщений/с - GET /stats
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+class FakeProvider:
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, max_batch: int = 1000):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.max_batch = max_batch
+        self.requests = 0
+        self.accepted = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.started: float = time.monotonic()
+
+    async def send(self, request: Request) -> JSONResponse:
+        messages = (await request.json())["messages"]
+        if len(messages) > self.max_batch:
+            return JSONResponse({"error": f"Batch larger than {self.max_batch}"}, status_code=413)
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        results = []
+        for _ in messages:
+            if random.random() < self.fail_rate:
+                self.failed += 1
+                results.append({"error": "Provider rejected message"})
+            else:
+                self.accepted += 1
+                results.append({"status": "ok"})
+        return JSONResponse({"results": results})
+
+    async def stats(self, request: Request) -> JSONResponse:
+        elapsed = time.monotonic() - self.started
+        return JSONResponse({
+            "requests": self.requests,
+            "accepted": self.accepted,
+            "failed": self.failed,
+            "max_in_flight": self.max_in_flight,
+            "messages_per_second": round(self.accepted / elapsed, 2) if elapsed else 0.0,
+        })
+
+    async def reset(self, request: Request) -> JSONResponse:
+        self.__init__(self.latency, self.fail_rate, self.max_batch)
+        return JSONResponse({"status": True})
+
+
+def create_app(provider: FakeProvider) -> Starlette:
+    return Starlette(routes=[
+        Route("/send", provider.send, methods=["POST"]),
+        Route("/stats", provider.stats),
+        Route("/reset", provider.reset, methods=["POST"]),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--max-batch", type=int, default=1000)
+    args = parser.parse_args()
+    app = create_app(FakeProvider(args.latency_ms / 1000, args.fail_rate, args.max_batch))
+    uvicorn.run(app, host=args.host, port=args.port)
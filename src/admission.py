@@ -0,0 +1,247 @@
+"""
+Admission control: лимит одновременных запросов по классам endpoint и сброс нагрузки.
+Класс запроса - по имени endpoint (ADMISSION_ENDPOINT_CLASSES), у класса свой лимит и срок ожидания
+места в очереди, не дождавшийся места запрос получает 503 с Retry-After.
+Классы из ADMISSION_SHED_CLASSES при перегрузке (лаг event loop, занятый пул БД) отклоняются сразу,
+не занимая ни очередь, ни соединения: change_token и confirm остаются быстрыми
+"""
+import asyncio
+import time
+from typing import Optional
+
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from config import Settings
+from src import diagnostics
+
+DEFAULT = "default"
+OVERLOADED = "Сервис перегружен, повторите запрос позже"
+
+
+class Gate:
+    """Лимит одновременных запросов одного класса и очередь ожидания не дольше queue_timeout"""
+    def __init__(self, name: str, limit: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.timed_out = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        """
+        Занимает место, при необходимости ожидая его
+        :return: False - место не освободилось за queue_timeout
+        """
+        if self._semaphore.locked() and self.queue_timeout <= 0:
+            self.timed_out += 1
+            return False
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return False
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def report(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue_timeout_ms": self.queue_timeout * 1000,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "timed_out": self.timed_out,
+            "shed": self.shed,
+            "avg_wait_ms": self.wait_total / self.admitted * 1000 if self.admitted else 0.0,
+            "max_wait_ms": self.wait_max * 1000,
+        }
+
+
+class LoadMonitor:
+    """
+    Лаг event loop - сглаженный lag diagnostics.LoopMonitor (одиночный всплеск не включает сброс).
+    При DIAGNOSTICS_ENABLED используется монитор диагностики, иначе свой, без сторожевого потока.
+    Занятость пула БД - доля выданных соединений от pool_capacity: при полной занятости новые запросы ждут соединение
+    """
+    def __init__(self, loop_monitor: Optional[diagnostics.LoopMonitor], engine: Optional[AsyncEngine],
+                 pool_capacity: int):
+        self.owns_loop_monitor = loop_monitor is None
+        self.loop_monitor = loop_monitor or diagnostics.LoopMonitor(watch=False)
+        self.engine = engine
+        self.pool_capacity = pool_capacity
+
+    @property
+    def lag(self) -> float:
+        return self.loop_monitor.lag
+
+    @property
+    def max_lag(self) -> float:
+        return self.loop_monitor.max_lag
+
+    def start(self) -> None:
+        if self.owns_loop_monitor:
+            self.loop_monitor.start()
+
+    async def stop(self) -> None:
+        if self.owns_loop_monitor:
+            await self.loop_monitor.stop()
+
+    def pool_usage(self) -> float:
+        if self.engine is None or not self.pool_capacity:
+            return 0.0
+        # NullPool/StaticPool (SQLite) не ведут счетчик выданных соединений
+        checkedout = getattr(self.engine.sync_engine.pool, "checkedout", None)
+        return checkedout() / self.pool_capacity if checkedout else 0.0
+
+
+class AdmissionController:
+    def __init__(self, gates: dict[str, Gate], endpoint_classes: dict[str, str], shed_classes: list[str],
+                 monitor: LoadMonitor, loop_lag_threshold: float, pool_usage_threshold: float, retry_after: int):
+        self.gates = gates
+        self.endpoint_classes = endpoint_classes
+        self.shed_classes = set(shed_classes)
+        self.monitor = monitor
+        self.loop_lag_threshold = loop_lag_threshold
+        self.pool_usage_threshold = pool_usage_threshold
+        self.retry_after = retry_after
+        self.shed_reasons = {"loop_lag": 0, "db_pool": 0}
+
+    def gate_for(self, endpoint: Optional[str]) -> Optional[Gate]:
+        return self.gates.get(self.endpoint_classes.get(endpoint, DEFAULT))
+
+    def overload(self) -> Optional[str]:
+        """Причина перегрузки либо None"""
+        if self.monitor.lag >= self.loop_lag_threshold:
+            return "loop_lag"
+        if self.monitor.pool_usage() >= self.pool_usage_threshold:
+            return "db_pool"
+        return None
+
+    def shed(self, gate: Gate) -> bool:
+        """Отклонить ли запрос класса gate сразу, не ставя в очередь"""
+        if gate.name not in self.shed_classes:
+            return False
+        reason = self.overload()
+        if reason is None:
+            return False
+        gate.shed += 1
+        self.shed_reasons[reason] += 1
+        return True
+
+    def report(self) -> dict:
+        return {
+            "loop_lag_ms": self.monitor.lag * 1000,
+            "max_loop_lag_ms": self.monitor.max_lag * 1000,
+            "db_pool_usage": round(self.monitor.pool_usage(), 3),
+            "shed_reasons": dict(self.shed_reasons),
+            "classes": {name: gate.report() for name, gate in self.gates.items()},
+        }
+
+
+class EndpointIndex:
+    """
+    Имя endpoint запроса до маршрутизации (как в LOG_SAMPLE_RATES) без полного прохода по маршрутам:
+    маршруты без параметров в пути ищутся словарем (метод, путь), route.matches проверяется
+    только у маршрутов с параметрами. Маршруты include_router лежат в app.router.routes плоским списком
+    """
+    def __init__(self, routes: list[BaseRoute]):
+        self.static: dict[tuple[str, str], str] = {}
+        self.dynamic: list[BaseRoute] = []
+        for route in routes:
+            path, methods = getattr(route, "path", None), getattr(route, "methods", None)
+            if path is None or methods is None or getattr(route, "param_convertors", None):
+                self.dynamic.append(route)
+                continue
+            for method in methods:
+                self.static.setdefault((method, path), route.name)
+
+    def endpoint_name(self, scope: Scope) -> Optional[str]:
+        name = self.static.get((scope["method"], scope["path"]))
+        if name is not None:
+            return name
+        for route in self.dynamic:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.name
+        return None
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware. Пока admission control выключен, только передает запрос дальше.
+    Индекс маршрутов строится по первому запросу: маршруты приложения к этому времени добавлены
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.endpoints: Optional[EndpointIndex] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        controller = _controller
+        if scope["type"] != "http" or controller is None:
+            await self.app(scope, receive, send)
+            return
+        if self.endpoints is None:
+            self.endpoints = EndpointIndex(scope["app"].router.routes)
+        gate = controller.gate_for(self.endpoints.endpoint_name(scope))
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+        if controller.shed(gate) or not await gate.acquire():
+            response = ORJSONResponse(status_code=503, content={"status": False, "error": OVERLOADED},
+                                      headers={"Retry-After": str(controller.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def enable(settings: Settings, engine: Optional[AsyncEngine] = None) -> None:
+    """
+    Запускает admission control по настройкам ADMISSION_*. Вызывается из lifespan внутри работающего loop,
+    после diagnostics.enable: лаг loop замеряет один монитор
+    """
+    global _controller
+    gates = {name: Gate(name, limit, settings.ADMISSION_QUEUE_MS.get(name, 0) / 1000)
+             for name, limit in settings.ADMISSION_LIMITS.items()}
+    monitor = LoadMonitor(diagnostics.loop_monitor, engine, settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW)
+    monitor.start()
+    _controller = AdmissionController(gates, settings.ADMISSION_ENDPOINT_CLASSES, settings.ADMISSION_SHED_CLASSES,
+                                      monitor, settings.ADMISSION_LOOP_LAG_MS / 1000, settings.ADMISSION_POOL_USAGE,
+                                      settings.ADMISSION_RETRY_AFTER_SECONDS)
+
+
+async def disable() -> None:
+    global _controller
+    if _controller is not None:
+        await _controller.monitor.stop()
+    _controller = None
+
+
+def report() -> Optional[dict]:
+    return _controller.report() if _controller else None
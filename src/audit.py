@@ -0,0 +1,127 @@
+"""
+Журнал входов (login_events). record не ходит в БД: событие кладется в буфер процесса,
+фоновая задача пишет буфер многострочным INSERT при AUDIT_BATCH_SIZE событиях либо раз в AUDIT_FLUSH_SECONDS.
+При остановке (main.lifespan) буфер дописывается
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert
+
+from orm import shard_router
+from src.log import request_stats
+from src.models import LoginEvent
+
+logger = logging.getLogger(__name__)
+
+LOGIN = "login"
+REFRESH = "refresh"
+QR_APPROVE = "qr_approve"
+CODE_FAILED = "code_failed"
+
+
+class AuditBuffer:
+    """
+    Очередь событий в памяти. Если БД недоступна, пачка возвращается в очередь,
+    сверх max_pending теряются самые старые события (счетчик dropped)
+    """
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 100_000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events: deque[dict] = deque(maxlen=max_pending)
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, event: dict) -> None:
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        if len(self.events) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self.events:
+            logger.error("Audit events lost on shutdown", extra={"events": len(self.events)})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            while self.events:
+                batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+                failed = []
+                for shard_id, events in shard_router.partition(batch, lambda event: event["user_id"]).items():
+                    try:
+                        async with shard_router.shards[shard_id].session() as db:
+                            await db.execute(insert(LoginEvent), events)
+                            await db.commit()
+                    except Exception:
+                        logger.exception("Audit flush failed", extra={"shard": shard_id, "events": len(events)})
+                        failed.extend(events)
+                        continue
+                    self.written += len(events)
+                if failed:
+                    # В очередь возвращаются только события недоступных шардов, повтор - по таймеру.
+                    # extendleft в полную очередь вытеснил бы самые новые события справа, поэтому
+                    # лишнее отрезается явно с начала пачки: она старше всего, что в очереди
+                    failed.sort(key=lambda event: event["created_at"])
+                    overflow = max(0, len(self.events) + len(failed) - self.events.maxlen)
+                    self.dropped += overflow
+                    self.events.extendleft(reversed(failed[overflow:]))
+                    return
+                self.flushes += 1
+
+
+_buffer: Optional[AuditBuffer] = None
+
+
+def init(batch_size: int, flush_interval: float, max_pending: int) -> None:
+    global _buffer
+    _buffer = AuditBuffer(batch_size, flush_interval, max_pending)
+    _buffer.start()
+
+
+async def close() -> None:
+    global _buffer
+    if _buffer is not None:
+        await _buffer.close()
+        _buffer = None
+
+
+def record(user_id: int, event: str, detail: Optional[str] = None) -> None:
+    """
+    Ставит событие в очередь, без init ничего не делает
+    :param user_id:
+    :param event: LOGIN, REFRESH, QR_APPROVE, CODE_FAILED
+    :param detail: способ входа либо причина отказа
+    :return:
+    """
+    if _buffer is None:
+        return
+    stats = request_stats.get()
+    _buffer.record({"user_id": user_id, "event": event, "detail": detail,
+                    "request_id": stats.request_id if stats else None, "created_at": datetime.utcnow()})
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Ограниченный in-memory кэш процесса с вытеснением давно неиспользуемых ключей.
+    ttl - время жизни записи в секундах, None - без ограничения
+    """
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class BloomFilter:
+    """
+    Вероятностное множество строк: отсутствие ключа точное, присутствие - с долей ложных
+    срабатываний около error_rate, пока элементов не больше capacity
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class SingleFlight:
+    """
+    Склеивает одновременные вызовы с одним ключом: первый выполняет запрос, остальные ждут его результат
+    либо исключение. window - сколько секунд после завершения результат еще отдается новым вызовам
+    (0 - только пока запрос в полете). Результат разделяется между вызывающими: это должно быть значение,
+    не привязанное к сессии (кортеж, bytes, pydantic), а не ORM-объект
+    """
+    def __init__(self, name: str, window: float = 0.0):
+        self.name = name
+        self.window = window
+        self.executed = 0
+        self.shared = 0
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        flights[name] = self
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        while (future := self._calls.get(key)) is not None:
+            self.shared += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Отменен выполнявший запрос, а не мы: повторяем сами
+                if not future.cancelled():
+                    raise
+                self.shared -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.executed += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            self._forget(key, future)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже получено вызывающим, ожидающих может и не быть
+            future.exception()
+            self._forget(key, future)
+            raise
+        future.set_result(result)
+        if self.window:
+            asyncio.get_running_loop().call_later(self.window, self._forget, key, future)
+        else:
+            self._forget(key, future)
+        return result
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def report(self) -> dict:
+        calls = self.executed + self.shared
+        return {
+            "executed": self.executed,
+            "shared": self.shared,
+            "keys": len(self._calls),
+            "shared_ratio": round(self.shared / calls, 3) if calls else 0.0,
+        }
+
+
+# Все SingleFlight процесса по имени, для /api/diagnostics
+flights: dict[str, SingleFlight] = {}
+
+
+def flights_report() -> dict:
+    return {name: flight.report() for name, flight in flights.items()}
@@ -0,0 +1,201 @@
+"""
+Режим диагностики: поиск блокировок event loop и выборочное профилирование запросов.
+Включается DIAGNOSTICS_ENABLED, результаты - в /api/diagnostics
+"""
+import asyncio
+import cProfile
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from src import admission, cache
+
+
+class LoopMonitor:
+    """
+    Задача в loop отмечает каждый свой такт, сторожевой поток проверяет отметку.
+    Если loop не отвечает дольше threshold, поток снимает стек потока loop:
+    это и есть код, который блокирует loop.
+    lag - сглаженный лаг такта, по нему сбрасывает нагрузку src.admission. watch=False - только замер лага,
+    без сторожевого потока
+    """
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, max_stacks: int = 100,
+                 smoothing: float = 0.2, watch: bool = True):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.smoothing = smoothing
+        self.watch = watch
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.ticks = 0
+        self.blocks = 0
+        self.stacks: Counter = Counter()
+        self._last_tick = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        if self.watch:
+            self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+            self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _tick(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - started - self.interval, 0.0)
+            self.ticks += 1
+            self.total_lag += lag
+            self.lag += (lag - self.lag) * self.smoothing
+            self.max_lag = max(self.max_lag, lag)
+            self._last_tick = time.monotonic()
+
+    def _watch(self) -> None:
+        reported_tick = None
+        while not self._stopped.wait(self.threshold / 2):
+            last_tick = self._last_tick
+            if time.monotonic() - last_tick < self.threshold or last_tick == reported_tick:
+                continue
+            # Один стек на одну блокировку
+            reported_tick = last_tick
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self.blocks += 1
+            stack = "".join(traceback.format_stack(frame))
+            if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                self.stacks[stack] += 1
+
+    def report(self, top: int = 10) -> dict:
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "avg_lag_ms": self.total_lag / self.ticks * 1000 if self.ticks else 0.0,
+            "max_lag_ms": self.max_lag * 1000,
+            "blocks": self.blocks,
+            "top_blocking_stacks": [{"count": count, "stack": stack} for stack, count in self.stacks.most_common(top)],
+        }
+
+
+class RequestProfiler:
+    """
+    Профилирует случайную долю запросов через cProfile и копит статистику функций.
+    Одновременно профилируется один запрос: cProfile видит весь поток loop
+    """
+    def __init__(self, sample_rate: float = 0.01, slow_request_threshold: float = 0.5):
+        self.sample_rate = sample_rate
+        self.slow_request_threshold = slow_request_threshold
+        self.stats: Optional[pstats.Stats] = None
+        self.requests = 0
+        self.slow_endpoints: Counter = Counter()
+        self._active = False
+
+    def start_profile(self) -> Optional[cProfile.Profile]:
+        if self._active or random.random() >= self.sample_rate:
+            return None
+        self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish_profile(self, profile: Optional[cProfile.Profile]) -> None:
+        if profile is None:
+            return
+        profile.disable()
+        self._active = False
+        self.requests += 1
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def add_timing(self, endpoint: str, elapsed: float) -> None:
+        if elapsed >= self.slow_request_threshold:
+            self.slow_endpoints[endpoint] += 1
+
+    def report(self, top: int = 20) -> dict:
+        functions = []
+        if self.stats is not None:
+            rows = sorted(self.stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            for (filename, line, name), (_, calls, own_time, cumulative_time, _) in rows:
+                functions.append({"function": f"{filename}:{line}({name})", "calls": calls,
+                                  "own_ms": own_time * 1000, "cumulative_ms": cumulative_time * 1000})
+        return {
+            "sample_rate": self.sample_rate,
+            "profiled_requests": self.requests,
+            "top_functions": functions,
+            "slow_requests_by_endpoint": dict(self.slow_endpoints.most_common(top)),
+        }
+
+
+class DiagnosticsMiddleware:
+    """ASGI middleware. Пока диагностика выключена, только передает запрос дальше"""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        profiler = request_profiler
+        if scope["type"] != "http" or profiler is None:
+            await self.app(scope, receive, send)
+            return
+        profile = profiler.start_profile()
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.finish_profile(profile)
+            endpoint = scope.get("endpoint")
+            profiler.add_timing(endpoint.__name__ if endpoint else scope["path"], time.monotonic() - started)
+
+
+loop_monitor: Optional[LoopMonitor] = None
+request_profiler: Optional[RequestProfiler] = None
+
+
+def enable(loop_lag_threshold: float, profile_sample_rate: float, slow_request_threshold: float) -> None:
+    """Запускает мониторинг. Вызывается из lifespan внутри работающего loop"""
+    global loop_monitor, request_profiler
+    loop_monitor = LoopMonitor(threshold=loop_lag_threshold)
+    loop_monitor.start()
+    request_profiler = RequestProfiler(profile_sample_rate, slow_request_threshold)
+
+
+async def disable() -> None:
+    global loop_monitor, request_profiler
+    if loop_monitor is not None:
+        await loop_monitor.stop()
+    loop_monitor = None
+    request_profiler = None
+
+
+def report() -> dict:
+    return {
+        "enabled": loop_monitor is not None,
+        "loop": loop_monitor.report() if loop_monitor else None,
+        "profiler": request_profiler.report() if request_profiler else None,
+        "single_flight": cache.flights_report(),
+        "admission": admission.report(),
+    }
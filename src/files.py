@@ -0,0 +1,121 @@
+"""
+Локальное контентно-адресуемое хранилище файлов.
+Блоб лежит по пути FILES_PATH/ab/cd/<sha256>, одинаковые файлы хранятся один раз
+"""
+import hashlib
+import os
+import uuid
+from typing import AsyncIterator, Optional
+
+import anyio
+from fastapi import HTTPException
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+from config import get_settings
+
+
+def blob_path(file_hash: str) -> str:
+    return os.path.join(get_settings().FILES_PATH, file_hash[:2], file_hash[2:4], file_hash)
+
+
+async def store_stream(chunks: AsyncIterator[bytes], max_size: int) -> tuple[str, str, int]:
+    """
+    Пишет поток во временный файл, считая sha256 на лету, и переносит его на место блоба.
+    Если такой блоб уже есть, временный файл удаляется
+    :param chunks: тело запроса
+    :param max_size: ограничение размера в байтах, 413 при превышении
+    :return: (hash, path, size)
+    """
+    tmp_dir = os.path.join(get_settings().FILES_PATH, "tmp")
+    await anyio.to_thread.run_sync(lambda: os.makedirs(tmp_dir, exist_ok=True))
+    tmp_path = os.path.join(tmp_dir, str(uuid.uuid4()))
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with await anyio.open_file(tmp_path, "wb") as tmp:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(413, "Файл слишком большой")
+                digest.update(chunk)
+                await tmp.write(chunk)
+        file_hash = digest.hexdigest()
+        path = blob_path(file_hash)
+        await anyio.to_thread.run_sync(_move_blob, tmp_path, path)
+    finally:
+        await anyio.to_thread.run_sync(_remove_if_exists, tmp_path)
+    return file_hash, path, size
+
+
+def _move_blob(tmp_path: str, path: str):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    Разбирает заголовок Range с одним диапазоном: bytes=start-end, bytes=start-, bytes=-suffix
+    :param range_header:
+    :param size: размер файла
+    :return: (start, end) включительно, None - отдать файл целиком
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        else:
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(416, "Запрошенный диапазон недоступен")
+    return start, end
+
+
+class RangeFileResponse(FileResponse):
+    """
+    FileResponse с поддержкой одного диапазона Range (206).
+    Если сервер поддерживает ASGI-расширение http.response.zerocopysend, файл отдается через sendfile
+    """
+    def __init__(self, path: str, size: int, byte_range: Optional[tuple[int, int]] = None, **kwargs):
+        self.start, self.end = byte_range if byte_range else (0, size - 1)
+        super().__init__(path, status_code=206 if byte_range else 200, **kwargs)
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["content-length"] = str(self.end - self.start + 1)
+        if byte_range:
+            self.headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if self.send_header_only or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file,
+                            "offset": self.start, "count": count, "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.start)
+                while count > 0:
+                    chunk = await file.read(min(self.chunk_size, count))
+                    if not chunk:
+                        break
+                    count -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+                if count > 0:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.background is not None:
+            await self.background()
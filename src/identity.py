@@ -0,0 +1,123 @@
+"""
+Кэш соответствия контакт (телефон/email) -> пользователь перед get_user_by_*.
+Bloom-фильтр содержит все контакты из users: контакт вне фильтра точно не зарегистрирован,
+такой запрос получает 404 без обращения к БД. Фильтр заполняется при старте потоковым чтением users
+и догружается новыми строками каждые IDENTITY_REFRESH_SECONDS (регистрации в соседних воркерах).
+id выдается до commit, поэтому строка с меньшим id может появиться позже строки с большим:
+догрузка перечитывает последние IDENTITY_REFRESH_OVERLAP_IDS id.
+LRU хранит только активных пользователей: активация необратима, поэтому запись не устаревает
+"""
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select
+
+from orm import db_manager
+from src.cache import BloomFilter, LRUCache
+from src.models import User
+
+LOAD_BATCH_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class Identity(NamedTuple):
+    id: int
+    is_active: bool
+
+
+def phone_key(phone_number: str) -> str:
+    return "phone:" + phone_number
+
+
+def email_key(email: str) -> str:
+    return "email:" + email
+
+
+def contact_key(data) -> Optional[str]:
+    """Ключ контакта из запроса с phone_number либо email"""
+    if getattr(data, 'phone_number', None):
+        return phone_key(data.phone_number)
+    if getattr(data, 'email', None):
+        return email_key(data.email)
+    return None
+
+
+class IdentityDirectory:
+    def __init__(self, capacity: int, maxsize: int, overlap: int = 1000):
+        self.contacts = BloomFilter(capacity)
+        self.active = LRUCache(maxsize=maxsize)
+        self.overlap = overlap
+        self.last_user_id = 0
+
+    def add(self, phone_number: Optional[str], email: Optional[str]) -> None:
+        if phone_number:
+            self.contacts.add(phone_key(phone_number))
+        if email:
+            self.contacts.add(email_key(email))
+
+    async def load(self) -> None:
+        """Дочитывает строки users с id больше уже загруженных за вычетом overlap"""
+        query = (select(User.id, User.phone_number, User.email)
+                 .where(User.id > self.last_user_id - self.overlap)
+                 .order_by(User.id)
+                 .execution_options(yield_per=LOAD_BATCH_SIZE))
+        async with db_manager.session() as session:
+            rows = await session.stream(query)
+            async for partition in rows.partitions():
+                for user_id, phone_number, email in partition:
+                    self.add(phone_number, email)
+                self.last_user_id = max(self.last_user_id, partition[-1][0])
+
+    async def refresh_forever(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Identity directory refresh failed")
+
+
+directory: Optional[IdentityDirectory] = None
+_refresh_task: Optional[asyncio.Task] = None
+
+
+async def init(capacity: int, maxsize: int, refresh_interval: float, overlap: int = 1000) -> None:
+    global directory, _refresh_task
+    loaded = IdentityDirectory(capacity, maxsize, overlap)
+    await loaded.load()
+    directory = loaded
+    _refresh_task = asyncio.get_running_loop().create_task(directory.refresh_forever(refresh_interval))
+
+
+async def close() -> None:
+    global directory, _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+    directory = None
+    _refresh_task = None
+
+
+def is_unregistered(key: str) -> bool:
+    return directory is not None and key not in directory.contacts
+
+
+def get_active(key: str) -> Optional[Identity]:
+    return directory.active.get(key) if directory is not None else None
+
+
+def remember_active(key: str, user_id: int) -> None:
+    """Контакт подтвержден в этом воркере: добавляется и в фильтр, не дожидаясь догрузки"""
+    if directory is not None:
+        directory.contacts.add(key)
+        directory.active.set(key, Identity(user_id, True))
+
+
+def add_contacts(phone_number: Optional[str], email: Optional[str]) -> None:
+    if directory is not None:
+        directory.add(phone_number, email)
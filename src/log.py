@@ -0,0 +1,188 @@
+"""
+Структурные JSON-логи. Запись в stdout идет в отдельном потоке через QueueHandler/QueueListener,
+event loop только кладет запись в очередь. Каждая запись несет request_id текущего запроса,
+итоговая запись запроса - время, endpoint, время и число запросов к БД
+"""
+import contextvars
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+from typing import Optional
+
+import orjson
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+
+RECORD_FIELDS = {"name", "msg", "args", "levelname", "levelno", "pathname", "filename", "module", "exc_info",
+                 "exc_text", "stack_info", "lineno", "funcName", "created", "msecs", "relativeCreated", "thread",
+                 "threadName", "processName", "process", "message", "taskName"}
+
+
+class RequestStats:
+    __slots__ = ("request_id", "db_time", "queries")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.db_time = 0.0
+        self.queries = 0
+
+
+request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """Запоминает request_id в записи в момент логирования, до передачи в очередь"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        stats = request_stats.get()
+        record.request_id = stats.request_id if stats else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_FIELDS)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    """
+    Штатный prepare форматирует запись целиком: traceback попадает в message, exc_info обнуляется.
+    Здесь до очереди подставляются только текст сообщения и traceback в exc_text,
+    в поток записи не уходят ни args, ни объекты исключения с кадрами стека
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = "INFO") -> None:
+    """Переключает корневой логгер на очередь, запись в stdout - в потоке QueueListener"""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    queue_handler = JsonQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь и останавливает поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Считает время и число запросов к БД в RequestStats текущего запроса.
+    Запрос, упавший с ошибкой, тоже учитывается и снимается со стека query_started соединения
+    """
+    def record_query(started: float) -> None:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.db_time += time.perf_counter() - started
+            stats.queries += 1
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append((context, time.perf_counter()))
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _, started = conn.info["query_started"].pop()
+        record_query(started)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(context):
+        # Ошибка до before_cursor_execute или после after_cursor_execute на стеке не отмечена
+        queries = context.connection.info.get("query_started") if context.connection is not None else None
+        if queries and queries[-1][0] is context.execution_context:
+            _, started = queries.pop()
+            record_query(started)
+
+
+class RequestLogMiddleware:
+    """
+    Присваивает запросу request_id (из X-Request-ID либо новый), возвращает его в ответе
+    и пишет итоговую запись. LOG_SAMPLE_RATES - доля логируемых запросов по имени endpoint,
+    ошибки 5xx логируются всегда
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        stats = RequestStats(request_id or uuid.uuid4().hex)
+        token = request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Request-ID", stats.request_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint else None
+            if status_code >= 500 or random.random() < get_settings().LOG_SAMPLE_RATES.get(endpoint, 1.0):
+                logger.info("request", extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "endpoint": endpoint,
+                    "status": status_code,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                    "db_ms": round(stats.db_time * 1000, 3),
+                    "db_queries": stats.queries,
+                })
+            request_stats.reset(token)
@@ -0,0 +1,149 @@
+"""
+Ручные миграции схемы для уже развернутых БД (PostgreSQL).
+create_all не изменяет существующие таблицы, поэтому изменения колонок применяются здесь.
+Все запросы идемпотентны, запуск: python -m src.migrations
+"""
+import asyncio
+import logging
+
+from sqlalchemy import select, text, update
+
+from config import get_settings
+from orm import db_manager
+from src.models import User
+from src.schemas import normalize_email, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+NORMALIZE_BATCH_SIZE = 10000
+
+REFRESH_TOKENS_MIGRATION = [
+    # Семьи токенов: старые токены становятся семьей из одного токена
+    "ALTER TABLE refresh_tokens ADD COLUMN IF NOT EXISTS family_id VARCHAR(36)",
+    "UPDATE refresh_tokens SET family_id = id::text WHERE family_id IS NULL",
+    "ALTER TABLE refresh_tokens ALTER COLUMN family_id SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix__refresh_tokens__family_id ON refresh_tokens (family_id)",
+    "CREATE INDEX IF NOT EXISTS ix__refresh_tokens__user_id_is_active ON refresh_tokens (user_id, is_active)",
+    # Открытые токены заменяются на sha256, совпадающий с utils.hash_refresh_token
+    "ALTER TABLE refresh_tokens ADD COLUMN IF NOT EXISTS token_hash BYTEA",
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'refresh_tokens' AND column_name = 'token') THEN
+            UPDATE refresh_tokens SET token_hash = sha256(convert_to(token, 'UTF8')) WHERE token_hash IS NULL;
+            ALTER TABLE refresh_tokens DROP COLUMN token;
+        END IF;
+    END $$
+    """,
+    "ALTER TABLE refresh_tokens ALTER COLUMN token_hash SET NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq__refresh_tokens__token_hash ON refresh_tokens (token_hash)",
+]
+
+VERIFICATION_CODES_MIGRATION = [
+    "ALTER TABLE verification_codes ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+]
+
+FILES_MIGRATION = [
+    "ALTER TABLE files ADD COLUMN IF NOT EXISTS size BIGINT",
+    "CREATE INDEX IF NOT EXISTS ix__files__hash ON files (hash)",
+    "CREATE INDEX IF NOT EXISTS ix__files__user_id_is_active ON files (user_id, is_active)",
+]
+
+
+def _inactive_duplicate_users(column: str) -> str:
+    """id неподтвержденных дублей по контакту: остается активный либо последний зарегистрированный"""
+    return f"""
+    SELECT id FROM (
+        SELECT id, is_active,
+               row_number() OVER (PARTITION BY {column} ORDER BY is_active DESC, created_at DESC, id DESC) AS rn
+        FROM users WHERE {column} IS NOT NULL
+    ) AS ranked WHERE rn > 1 AND NOT is_active
+    """
+
+
+def _drop_duplicate_users(column: str) -> list[str]:
+    duplicates = _inactive_duplicate_users(column)
+    return [
+        f"DELETE FROM {table} WHERE user_id IN ({duplicates})"
+        for table in ("verification_codes", "user_roles", "refresh_tokens")
+    ] + [f"DELETE FROM users WHERE id IN ({duplicates})"]
+
+
+USERS_MIGRATION = [
+    # id Telegram давно вышли за пределы int4
+    "ALTER TABLE users ALTER COLUMN telegram_id TYPE BIGINT",
+    # Нормализация контактов (normalize_user_contacts) может свести две строки к одному контакту:
+    # уникальность проверяется заново после удаления дублей. Без индексов регистрации не защищены
+    # от дублей, поэтому миграция запускается при остановленном приложении
+    "DROP INDEX IF EXISTS uq__users__email",
+    "DROP INDEX IF EXISTS uq__users__phone_number",
+]
+
+USERS_CONTACTS_MIGRATION = [
+    # Один пользователь на контакт (models.User.__table_args__). Несколько активных пользователей
+    # с одним контактом не удаляются: создание индекса упадет, их нужно разобрать вручную
+    *_drop_duplicate_users("email"),
+    *_drop_duplicate_users("phone_number"),
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq__users__email ON users (email) WHERE email IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq__users__phone_number ON users (phone_number) WHERE phone_number IS NOT NULL",
+    "DROP INDEX IF EXISTS ix__users__email",
+    "DROP INDEX IF EXISTS ix__users__phone_number",
+]
+
+
+async def migrate(statements: list[str]):
+    async with db_manager.connect() as connection:
+        for statement in statements:
+            await connection.execute(text(statement))
+
+
+async def normalize_user_contacts() -> int:
+    """
+    Приводит email и phone_number к форме schemas.normalize_email / normalize_phone теми же функциями,
+    что разбирают запросы (в том числе IDNA домена). users читается потоком, меняются только отличающиеся строки.
+    Значения, которые функции не принимают, остаются как есть и попадают в лог
+    :return: число измененных пользователей
+    """
+    changes = []
+    async with db_manager.session() as session:
+        rows = await session.stream(select(User.id, User.email, User.phone_number)
+                                    .execution_options(yield_per=NORMALIZE_BATCH_SIZE))
+        async for partition in rows.partitions():
+            for user_id, email, phone_number in partition:
+                change = {}
+                for column, value, normalize in (("email", email, normalize_email),
+                                                 ("phone_number", phone_number, normalize_phone)):
+                    if value is None:
+                        continue
+                    try:
+                        normalized = normalize(value)
+                    except (ValueError, UnicodeError) as e:
+                        logger.warning("Contact left as is", extra={"user_id": user_id, "column": column,
+                                                                    "error": str(e)})
+                        continue
+                    if normalized != value:
+                        change[column] = normalized
+                if change:
+                    changes.append({"id": user_id, **change})
+    async with db_manager.session() as session:
+        for i in range(0, len(changes), NORMALIZE_BATCH_SIZE):
+            # UPDATE по первичному ключу пачкой (executemany)
+            await session.execute(update(User), changes[i:i + NORMALIZE_BATCH_SIZE])
+        await session.commit()
+    return len(changes)
+
+
+async def main():
+    db_manager.init(get_settings().DATABASE_URL)
+    await migrate(REFRESH_TOKENS_MIGRATION)
+    await migrate(USERS_MIGRATION)
+    await normalize_user_contacts()
+    await migrate(USERS_CONTACTS_MIGRATION)
+    await migrate(FILES_MIGRATION)
+    await migrate(VERIFICATION_CODES_MIGRATION)
+    await db_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,17 @@
 import enum
+import logging
 from datetime import datetime, timedelta
 from typing import Optional
 
-from sqlalchemy import String, DateTime, func, Integer, ForeignKey, Date, Boolean, insert, TIMESTAMP
+from sqlalchemy import String, DateTime, func, Integer, ForeignKey, Date, Boolean, insert, TIMESTAMP, Index, \
+    LargeBinary, BigInteger, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from orm import db_manager
 from orm.base_model import OrmBase
 
+logger = logging.getLogger(__name__)
+
 
 class Role(OrmBase):
     """
@@ -26,7 +30,7 @@ class Role(OrmBase):
                 await session.execute(insert(Role).values(id=id, name=name))
                 await session.commit()
             except Exception as e:
-                print(e)
+                logger.info("Role was not created", extra={"role_id": id, "role": name, "error": str(e)})
 
 
 class User(OrmBase):
@@ -34,6 +38,13 @@ class User(OrmBase):
     Базовая информация о пользователе
     """
     __tablename__ = "users"
+    # Один пользователь на контакт: неподтвержденная регистрация переиспользуется через
+    # INSERT ... ON CONFLICT (service.register_user). Условие совпадает с index_where в upsert
+    __table_args__ = (
+        Index("uq__users__email", "email", unique=True, postgresql_where=text("email IS NOT NULL")),
+        Index("uq__users__phone_number", "phone_number", unique=True,
+              postgresql_where=text("phone_number IS NOT NULL")),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     first_name: Mapped[str] = mapped_column(String(50), nullable=False)
@@ -41,9 +52,10 @@ class User(OrmBase):
     middle_name: Mapped[Optional[str]] = mapped_column(String(50))
     birth_date: Mapped[Optional[Date]] = mapped_column(Date)
     gender: Mapped[Optional[int]] = mapped_column(Integer)
-    email: Mapped[Optional[str]] = mapped_column(String(255), index=True)
-    phone_number: Mapped[Optional[str]] = mapped_column(String(20), index=True)
-    telegram_id: Mapped[Optional[int]] = mapped_column(Integer, unique=True, index=True)
+    # Контакты хранятся в нормализованном виде (schemas.normalize_email / normalize_phone)
+    email: Mapped[Optional[str]] = mapped_column(String(255))
+    phone_number: Mapped[Optional[str]] = mapped_column(String(20))
+    telegram_id: Mapped[Optional[int]] = mapped_column(BigInteger, unique=True, index=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=False)
     is_email_confirmed: Mapped[bool] = mapped_column(Boolean, default=False)
     is_phone_confirmed: Mapped[bool] = mapped_column(Boolean, default=False)
@@ -57,12 +69,14 @@ class VerificationCode(OrmBase):
     __tablename__ = "verification_codes"
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # Без внешнего ключа на users: при DATABASE_SHARD_URLS таблица лежит в шарде, где users нет
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
     verification_type: Mapped[str] = mapped_column(String, nullable=False)
     code: Mapped[int] = mapped_column(Integer, nullable=False)
     expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
 
 
 class UserRoles(OrmBase):
@@ -78,23 +92,41 @@ class UserRoles(OrmBase):
 
 
 class RefreshToken(OrmBase):
+    """
+    Refresh токены. Каждый refresh выпускает новый токен той же семьи (family_id),
+    старый деактивируется. Повторное использование неактивного токена отзывает всю семью.
+    Сам токен не хранится, только его sha256 (token_hash)
+    """
     __tablename__ = "refresh_tokens"
+    __table_args__ = (
+        Index("ix__refresh_tokens__user_id_is_active", "user_id", "is_active"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
-    token: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
+    # Без внешнего ключа на users, как у VerificationCode
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    family_id: Mapped[str] = mapped_column(String(36), nullable=False, index=True)
+    token_hash: Mapped[bytes] = mapped_column(LargeBinary(32), unique=True, nullable=False)
     expires_at: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
 
 
 class File(OrmBase):
+    """
+    Файлы пользователей. Содержимое хранится по sha256 (hash), строки с одинаковым hash
+    ссылаются на один блоб
+    """
     __tablename__ = "files"
+    __table_args__ = (
+        Index("ix__files__user_id_is_active", "user_id", "is_active"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String)
     user_id: Mapped[int] = mapped_column(Integer, index=True)
-    hash: Mapped[str] = mapped_column(String)
+    hash: Mapped[str] = mapped_column(String(64), index=True)
     path: Mapped[str] = mapped_column(String)
     type: Mapped[str] = mapped_column(String)
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     create_date: Mapped[datetime] = mapped_column(TIMESTAMP, default=datetime.now)
     modify_date: Mapped[datetime] = mapped_column(
@@ -102,6 +134,56 @@ class File(OrmBase):
     )
 
 
+class OutboxMessage(OrmBase):
+    """
+    Исходящие сообщения (коды подтверждения). Пишутся в одной транзакции с VerificationCode,
+    отправляются воркерами src.outbox. sent_at IS NULL - сообщение еще в очереди
+    """
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index("ix__outbox__available_at", "available_at", postgresql_where=text("sent_at IS NULL")),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel: Mapped[str] = mapped_column(String(16), nullable=False)
+    recipient: Mapped[str] = mapped_column(String(255), nullable=False)
+    subject: Mapped[Optional[str]] = mapped_column(String(255))
+    body: Mapped[str] = mapped_column(String, nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_error: Mapped[Optional[str]] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Следующая попытка не раньше available_at, после expires_at сообщение не отправляется
+    available_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+
+class LoginEvent(OrmBase):
+    """
+    Журнал входов: вход по коду, refresh, подтверждение QR, неверный код.
+    Пишется пачками через src.audit, история пользователя читается по (user_id, id)
+    """
+    __tablename__ = "login_events"
+    __table_args__ = (
+        Index("ix__login_events__user_id_id", "user_id", "id"),
+    )
+
+    # В SQLite автоинкремент есть только у INTEGER PRIMARY KEY
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    event: Mapped[str] = mapped_column(String(32), nullable=False)
+    detail: Mapped[Optional[str]] = mapped_column(String(255))
+    request_id: Mapped[Optional[str]] = mapped_column(String(64))
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+# Таблицы, которые при DATABASE_SHARD_URLS живут в шардах по user_id (orm.shard_router), а не в основной БД.
+# Код подтверждения находится по номеру шарда в code_id, refresh токен - по префиксу токена.
+# outbox пишется в одной транзакции с кодом, поэтому лежит в том же шарде.
+# user_roles остается в основной: роли читаются вместе с users (service.get_telegram_user_role_mask)
+SHARDED_TABLES = [VerificationCode.__table__, RefreshToken.__table__, OutboxMessage.__table__, LoginEvent.__table__]
+
+
 class QRAuthTokens(OrmBase):
     __tablename__ = "qr_tokens"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -0,0 +1,397 @@
+"""
+Transactional outbox для доставки кодов подтверждения.
+Сообщение пишется в outbox в той же транзакции, что и VerificationCode: откатившийся код не отправляется,
+закоммиченный не теряется при падении процесса. Воркеры забирают пачки через FOR UPDATE SKIP LOCKED,
+поэтому их можно запускать в нескольких процессах: python -m src.outbox.
+Отправка идет вне транзакции: пачка захватывается арендой (available_at) в одной короткой транзакции,
+результат пишется в другой. Сообщение воркера, упавшего во время отправки, уйдет повторно после аренды.
+При DATABASE_SHARD_URLS outbox лежит в шардах рядом с кодами, воркеры обходят все шарды
+"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Protocol
+
+from sqlalchemy import select, update, delete, func, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import get_settings, Settings
+from mail.MailClient import BaseSMTPClient, SMTPSSLClient, SMTPTLSClient, StubSMTPClient
+from orm import db_manager, shard_router
+from orm.session_manager import DatabaseSessionManager
+from sms.SMSClient import BaseSMSClient, HTTPSMSClient, StubSMSClient
+from src import log
+from src.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+EMAIL = "email"
+SMS = "sms"
+CODE_SUBJECT = "Код подтверждения"
+CODE_BODY = "Ваш код подтверждения: {code}"
+MAX_BACKOFF_SECONDS = 60.0
+PURGE_BATCH_SIZE = 10000
+
+
+class Message(NamedTuple):
+    recipient: str
+    subject: Optional[str]
+    body: str
+
+
+class Transport(Protocol):
+    async def send(self, messages: list[Message]) -> list[Optional[str]]:
+        """
+        Отправляет пачку сообщений одного канала
+        :param messages:
+        :return: ошибка по каждому сообщению в порядке messages, None - доставлено
+        """
+
+
+class SMTPTransport:
+    """
+    Письма через mail.MailClient. smtplib синхронный: пачка отправляется в отдельном потоке
+    по одному соединению
+    """
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.from_addr = settings.SMTP_FROM or settings.SMTP_USER or "noreply@localhost"
+
+    def client(self) -> BaseSMTPClient:
+        if not self.settings.SMTP_HOST:
+            return StubSMTPClient.from_settings(self.settings)
+        if self.settings.SMTP_PORT in (None, 465):
+            return SMTPSSLClient.from_settings(self.settings)
+        return SMTPTLSClient.from_settings(self.settings)
+
+    async def send(self, messages: list[Message]) -> list[Optional[str]]:
+        return await asyncio.to_thread(self._send, messages)
+
+    def _send(self, messages: list[Message]) -> list[Optional[str]]:
+        try:
+            client = self.client()
+        except Exception as e:
+            return [repr(e)] * len(messages)
+        errors = []
+        try:
+            for message in messages:
+                try:
+                    client.send_email(self.from_addr, [message.recipient], message.subject or "", message.body)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(repr(e))
+        finally:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        return errors
+
+
+class SMSTransport:
+    """SMS через sms.SMSClient: пачкование и лимит параллельных запросов - на стороне клиента"""
+    def __init__(self, client: BaseSMSClient):
+        self.client = client
+
+    async def send(self, messages: list[Message]) -> list[Optional[str]]:
+        return await self.client.send_many([(message.recipient, message.body) for message in messages])
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def transports_from_settings(settings: Settings) -> dict[str, Transport]:
+    """Без SMS_PROVIDER_URL SMS остаются в sms.SMSClient.StubSMSClient, без SMTP_HOST письма - в StubSMTPClient"""
+    sms_client = HTTPSMSClient.from_settings(settings) if settings.SMS_PROVIDER_URL else StubSMSClient()
+    return {EMAIL: SMTPTransport(settings), SMS: SMSTransport(sms_client)}
+
+
+def enqueue(db: AsyncSession, channel: str, recipient: str, body: str, expires_at: datetime,
+            subject: Optional[str] = None) -> OutboxMessage:
+    """
+    Добавляет сообщение в сессию без commit: уйдет в БД вместе с транзакцией вызывающего
+    :param db:
+    :param channel: EMAIL или SMS
+    :param recipient:
+    :param body:
+    :param expires_at: после этого времени сообщение не отправляется
+    :param subject:
+    :return:
+    """
+    message = OutboxMessage(channel=channel, recipient=recipient, subject=subject, body=body, expires_at=expires_at)
+    db.add(message)
+    return message
+
+
+def enqueue_code(db: AsyncSession, data, code: int, expires_at: datetime) -> OutboxMessage:
+    """
+    Код подтверждения на phone_number (SMS) либо email из запроса
+    :param db:
+    :param data: запрос с phone_number либо email
+    :param code:
+    :param expires_at: срок действия кода
+    :return:
+    """
+    if getattr(data, 'phone_number', None):
+        channel, recipient = SMS, data.phone_number
+    else:
+        channel, recipient = EMAIL, data.email
+    return enqueue(db, channel, recipient, CODE_BODY.format(code=code), expires_at, subject=CODE_SUBJECT)
+
+
+def pending(now: datetime, max_attempts: int):
+    return and_(OutboxMessage.sent_at.is_(None),
+                OutboxMessage.available_at <= now,
+                OutboxMessage.expires_at > now,
+                OutboxMessage.attempts < max_attempts)
+
+
+class OutboxWorkerPool:
+    """
+    workers задач, каждая в цикле захватывает до batch_size готовых сообщений, раскладывает по каналам
+    и отправляет пачками. Неудачная отправка откладывается с экспоненциальной задержкой и jitter.
+    Первая задача раз в purge_interval удаляет сообщения старше retention: отправленные и просроченные
+    """
+    def __init__(self, transports: dict[str, Transport], workers: int = 2, batch_size: int = 100,
+                 poll_interval: float = 1.0, max_attempts: int = 8, backoff: float = 2.0, lease: float = 120.0,
+                 retention: float = 86400.0, purge_interval: float = 60.0):
+        self.transports = transports
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.delivered = 0
+        self.errors = 0
+        self.batches = 0
+        self.purged = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._run(purge=i == 0), name=f"outbox-{i}") for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for transport in self.transports.values():
+            if hasattr(transport, "aclose"):
+                await transport.aclose()
+
+    def backoff_delay(self, attempts: int) -> float:
+        return min(MAX_BACKOFF_SECONDS, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+    async def _run(self, purge: bool = False) -> None:
+        next_purge = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if purge and loop.time() >= next_purge:
+                    next_purge = loop.time() + self.purge_interval
+                    await self.purge_once()
+                processed = await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Outbox batch failed")
+                processed = 0
+            # Полная пачка - очередь не пуста, следующая без ожидания
+            if processed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def claim(self, shard: DatabaseSessionManager) -> list:
+        """
+        Захватывает пачку одним UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING:
+        попытка засчитывается сразу, available_at сдвигается на время аренды. Транзакция сразу коммитится
+        :param shard: БД outbox
+        :return: строки id, channel, recipient, subject, body, created_at, attempts
+        """
+        now = datetime.utcnow()
+        ready = (select(OutboxMessage.id)
+                 .where(pending(now, self.max_attempts))
+                 .order_by(OutboxMessage.id)
+                 .limit(self.batch_size)
+                 .with_for_update(skip_locked=True))
+        async with shard.session() as db:
+            claimed = await db.execute(update(OutboxMessage)
+                                       .where(OutboxMessage.id.in_(ready))
+                                       .values(attempts=OutboxMessage.attempts + 1,
+                                               available_at=now + timedelta(seconds=self.lease))
+                                       .returning(OutboxMessage.id, OutboxMessage.channel, OutboxMessage.recipient,
+                                                  OutboxMessage.subject, OutboxMessage.body,
+                                                  OutboxMessage.created_at, OutboxMessage.attempts)
+                                       .execution_options(synchronize_session=False))
+            claimed = claimed.all()
+            await db.commit()
+        return claimed
+
+    async def drain_once(self) -> int:
+        """
+        По пачке из каждого шарда
+        :return: наибольшая пачка: полная - очередь шарда не пуста
+        """
+        processed = 0
+        for shard in shard_router.shards:
+            processed = max(processed, await self.drain_shard(shard))
+        return processed
+
+    async def drain_shard(self, shard: DatabaseSessionManager) -> int:
+        """
+        Одна пачка: захват, отправка без открытой транзакции и соединения, запись результата
+        :param shard: БД outbox
+        :return: число обработанных сообщений
+        """
+        messages = await self.claim(shard)
+        if not messages:
+            return 0
+        channels: dict[str, list] = {}
+        for message in messages:
+            channels.setdefault(message.channel, []).append(message)
+        results = await asyncio.gather(*(self._deliver(channel, batch) for channel, batch in channels.items()))
+        async with shard.session() as db:
+            # UPDATE по первичному ключу пачкой (executemany)
+            await db.execute(update(OutboxMessage), [row for rows in results for row in rows])
+            await db.commit()
+        self.batches += 1
+        return len(messages)
+
+    async def _deliver(self, channel: str, messages: list) -> list[dict]:
+        """:return: изменения строк outbox по результату отправки"""
+        transport = self.transports.get(channel)
+        if transport is None:
+            errors = [f"No transport for channel {channel}"] * len(messages)
+        else:
+            try:
+                errors = await transport.send([Message(m.recipient, m.subject, m.body) for m in messages])
+            except Exception as e:
+                errors = [repr(e)] * len(messages)
+        now = datetime.utcnow()
+        rows = []
+        for message, error in zip(messages, errors):
+            if error is None:
+                rows.append({"id": message.id, "sent_at": now, "last_error": None})
+                lag = (now - message.created_at).total_seconds()
+                self.delivered += 1
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+            else:
+                rows.append({"id": message.id, "last_error": error[:1000],
+                             "available_at": now + timedelta(seconds=self.backoff_delay(message.attempts))})
+                self.errors += 1
+                logger.warning("Outbox delivery failed",
+                               extra={"channel": channel, "outbox_id": message.id, "attempts": message.attempts,
+                                      "error": error[:1000]})
+        return rows
+
+    async def purge_once(self) -> int:
+        """
+        Удаляет сообщения старше retention: отправленные и те, что уже не будут отправлены (истек expires_at).
+        Удаление идет порциями по PURGE_BATCH_SIZE от меньших id, в каждом шарде
+        :return: число удаленных
+        """
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.retention)
+        stale = (select(OutboxMessage.id)
+                 .where(OutboxMessage.created_at < cutoff,
+                        or_(OutboxMessage.sent_at.isnot(None), OutboxMessage.expires_at <= now))
+                 .order_by(OutboxMessage.id)
+                 .limit(PURGE_BATCH_SIZE))
+        purged = 0
+        for shard in shard_router.shards:
+            while True:
+                async with shard.session() as db:
+                    result = await db.execute(delete(OutboxMessage)
+                                              .where(OutboxMessage.id.in_(stale))
+                                              .execution_options(synchronize_session=False))
+                    await db.commit()
+                purged += result.rowcount
+                if result.rowcount < PURGE_BATCH_SIZE:
+                    break
+        self.purged += purged
+        return purged
+
+
+_pool: Optional[OutboxWorkerPool] = None
+
+
+def start(settings: Settings, workers: Optional[int] = None) -> OutboxWorkerPool:
+    global _pool
+    _pool = OutboxWorkerPool(transports_from_settings(settings),
+                             workers=settings.OUTBOX_WORKERS if workers is None else workers,
+                             batch_size=settings.OUTBOX_BATCH_SIZE,
+                             poll_interval=settings.OUTBOX_POLL_SECONDS,
+                             max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+                             backoff=settings.OUTBOX_BACKOFF_SECONDS,
+                             lease=settings.OUTBOX_LEASE_SECONDS,
+                             retention=settings.OUTBOX_RETENTION_HOURS * 3600)
+    _pool.start()
+    return _pool
+
+
+async def stop() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        _pool = None
+
+
+async def stats(db: AsyncSession) -> dict:
+    """
+    Глубина очереди и задержка доставки. queue_depth и oldest_pending_seconds - по БД всех шардов
+    (все процессы), остальное - по воркерам этого процесса
+    """
+    now = datetime.utcnow()
+    settings = get_settings()
+    pending_stats = (select(func.count(), func.min(OutboxMessage.created_at))
+                     .where(OutboxMessage.sent_at.is_(None),
+                            OutboxMessage.expires_at > now,
+                            OutboxMessage.attempts < settings.OUTBOX_MAX_ATTEMPTS))
+    depth, oldest = 0, None
+    for shard_id in range(len(shard_router.shards)):
+        async with shard_router.session(shard_id, db) as shard_db:
+            shard_depth, shard_oldest = (await shard_db.execute(pending_stats)).one()
+        depth += shard_depth
+        if shard_oldest is not None and (oldest is None or shard_oldest < oldest):
+            oldest = shard_oldest
+    report = {
+        "queue_depth": depth,
+        "oldest_pending_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+    }
+    if _pool is not None:
+        report.update({
+            "workers": _pool.workers,
+            "batches": _pool.batches,
+            "delivered": _pool.delivered,
+            "errors": _pool.errors,
+            "purged": _pool.purged,
+            "avg_delivery_lag_seconds": round(_pool.lag_total / _pool.delivered, 3) if _pool.delivered else 0.0,
+            "max_delivery_lag_seconds": round(_pool.lag_max, 3),
+        })
+    return report
+
+
+async def main():
+    settings = get_settings()
+    log.setup_logging(settings.LOG_LEVEL)
+    db_manager.init(settings.DATABASE_URL, settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+    shard_router.init(settings.DATABASE_SHARD_URLS, settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+    start(settings, workers=max(settings.OUTBOX_WORKERS, 1))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop()
+        await shard_router.close()
+        await db_manager.close()
+        log.shutdown_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""
+Рендер и загрузка изображений QR-кодов.
+PIL, qrcode_styled и requests_async импортируются только здесь: модуль загружается
+лениво из QRCodeGenerator, чтобы воркеры не платили за них при старте
+"""
+import logging
+import os
+
+import requests_async
+from PIL import Image
+from fastapi import HTTPException
+from qrcode_styled import QRCodeStyled, ERROR_CORRECT_Q
+
+from config import get_settings
+
+UPLOAD_PHOTO_URL = 'http://s33.enotgpt.ru/upload/photo'
+
+logger = logging.getLogger(__name__)
+
+
+def render_styled_qr(data: str, path: str, image_path=None, lossless=True, quality=100, fill_color=None,
+                     background_color='black'):
+    """
+    Рисует QR-код и сохраняет его в PNG
+    :param data: содержимое QR-кода
+    :param path: куда сохранить
+    :param image_path: картинка в центре QR-кода
+    :return:
+    """
+    qr = QRCodeStyled(border=2)
+    qr.error_correction = ERROR_CORRECT_Q
+    image = None
+    if image_path:
+        image = Image.open(image_path)
+
+    img = qr.get_image(data, image=image)
+
+    img.fill_color = fill_color
+    img.back_color = background_color
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as stream:
+        img.save(stream, 'PNG', lossless=lossless, quality=quality)
+
+
+async def upload_photo(path: str):
+    token = get_settings().ADMIN
+    headers = {
+        'accept': 'application/json',
+        'Authorization': f'Bearer {token}',
+    }
+
+    file_name = os.path.basename(path)
+    with open(path, 'rb') as file:
+        files = {'file': (file_name, file, 'image/png')}
+        response = await requests_async.post(UPLOAD_PHOTO_URL, headers=headers, files=files)
+
+    logger.info("QR image uploaded", extra={"file": file_name, "status": response.status_code})
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise HTTPException(403, "Error create qr code: " + response.text)
@@ -0,0 +1,116 @@
+"""
+Проверка доступа по битовым маскам ролей. Бит роли - 1 << (roles.id - 1): он одинаков во всех процессах
+и не меняется при перезапуске, поэтому маска ролей пользователя кладется в access токен (claim rm).
+Имена ролей из таблицы roles компилируются в маски при старте (load), проверка доступа - одно AND
+"""
+import logging
+from typing import Hashable, Iterable
+
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import select
+
+from orm import db_manager
+from src.models import Role
+from src.utils import verify_jwt_token
+
+logger = logging.getLogger(__name__)
+
+# Разрешение -> роли, которым оно выдано
+PERMISSIONS: dict[str, tuple[str, ...]] = {
+    "users:read": ("admin",),
+    "logins:read": ("admin",),
+    "tokens:introspect": ("admin", "service"),
+    "diagnostics:read": ("admin",),
+}
+
+security = HTTPBearer()
+
+_role_bits: dict[str, int] = {}
+# Требования зависимостей require_* -> роли и скомпилированная маска
+_requirements: dict[Hashable, tuple[str, ...]] = {}
+_masks: dict[Hashable, int] = {}
+
+
+def role_bit(role_id: int) -> int:
+    return 1 << (role_id - 1)
+
+
+def mask_from_role_ids(role_ids: Iterable[int]) -> int:
+    mask = 0
+    for role_id in role_ids:
+        mask |= role_bit(role_id)
+    return mask
+
+
+def roles_mask(roles: Iterable[str]) -> int:
+    """Маска по именам ролей. Роли, которых нет в таблице roles, не дают битов"""
+    mask = 0
+    for role in roles:
+        mask |= _role_bits.get(role, 0)
+    return mask
+
+
+def role_names(mask: int) -> list[str]:
+    return [role for role, bit in _role_bits.items() if mask & bit]
+
+
+def compile_roles(roles: Iterable[tuple[int, str]]) -> None:
+    """
+    Пересчитывает маски имен ролей и всех зарегистрированных требований
+    :param roles: пары (roles.id, roles.name)
+    :return:
+    """
+    global _role_bits
+    _role_bits = {name: role_bit(role_id) for role_id, name in roles}
+    for key, required in _requirements.items():
+        _masks[key] = roles_mask(required)
+        if not _masks[key]:
+            logger.warning("No known roles for requirement, access denied for everyone",
+                           extra={"requirement": str(key), "roles": required})
+
+
+async def load() -> None:
+    """Читает таблицу roles. Роль, добавленная после старта, учитывается после перезапуска"""
+    async with db_manager.session() as db:
+        roles = (await db.execute(select(Role.id, Role.name))).all()
+    compile_roles(roles)
+
+
+def token_mask(claims: dict) -> int:
+    """Маска ролей из claims. Токены, выпущенные до маски, несут список roles"""
+    mask = claims.get("rm")
+    if mask is None:
+        return roles_mask(claims.get("roles", []))
+    return mask
+
+
+def _require(key: Hashable, roles: tuple[str, ...]):
+    _requirements[key] = roles
+    _masks[key] = roles_mask(roles)
+
+    async def dependency(token: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+        claims = await verify_jwt_token(token)
+        if not token_mask(claims) & _masks[key]:
+            raise HTTPException(403, "Недостаточно прав")
+        return claims
+
+    return dependency
+
+
+def require_roles(*roles: str):
+    """
+    Зависимость FastAPI: токен действителен и у пользователя есть хотя бы одна из ролей
+    :param roles:
+    :return: claims токена
+    """
+    return _require(roles, roles)
+
+
+def require_permission(permission: str):
+    """
+    Зависимость FastAPI: у пользователя есть роль с разрешением из PERMISSIONS
+    :param permission:
+    :return: claims токена
+    """
+    return _require(permission, PERMISSIONS[permission])
@@ -1,22 +1,50 @@
-from fastapi import APIRouter, Depends
+import functools
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, Query, Header, Request
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
 import orm
-from src import service
+from src import service, diagnostics, outbox, rbac
 from src.models import User
 from src.schemas import (  # APIUserResponse, UserResponse, APIUserListResponse, UserCreateRequest,
     UserCreatePhoneRequest, UserCreateEmailRequest, RegistrationPhoneConfirm,
     RegistrationEmailConfirm, AuthGetCodeByPhone, AuthGetCodeByEmail, AuthGetOutput, UserCreateResponse,
     RegistrationResponse, AuthConfirmPhone, AuthConfirmEmail, ChangeToken, ChangeTokenOutput, AuthOutput,
     AuthGetCodeByPhoneTelegram, AuthGetCodeByEmailTelegram, AuthConfirmPhoneTelegram, AuthConfirmEmailTelegram,
-    GetQROutput)
+    GetQROutput, SuccessResponse, UserOutput, UsersByIds, UsersListOutput, UsersPageOutput, IntrospectRequest,
+    IntrospectOutput, AuthTelegramBatchConfirm, AuthTelegramBatchOutput, AuthTelegramLogin, FileOutput,
+    FilesPageOutput, LoginEventsPageOutput)
 from src.utils import verify_jwt_token
 
-router = APIRouter()
+
+
+class ModelResponseRoute(APIRoute):
+    """
+    Модель, которую вернул endpoint, сериализуется один раз через model_dump_json.
+    Штатный путь FastAPI (model_dump, повторная валидация по response_model, jsonable_encoder, orjson)
+    не используется, response_model остается для OpenAPI. Остальные ответы (dict, Response) - как обычно
+    """
+    def __init__(self, path: str, endpoint, **kwargs):
+        status_code = kwargs.get("status_code") or 200
+
+        @functools.wraps(endpoint)
+        async def serialized_endpoint(*args, **endpoint_kwargs):
+            result = await endpoint(*args, **endpoint_kwargs)
+            if isinstance(result, BaseModel):
+                return Response(result.model_dump_json(), status_code=status_code, media_type="application/json")
+            return result
+
+        super().__init__(path, serialized_endpoint, **kwargs)
+
+
+router = APIRouter(route_class=ModelResponseRoute)
 security = HTTPBearer()
 
 # @router.get("/{user_id}/", response_model=APIUserResponse)
@@ -142,6 +170,28 @@ async def change_token(data: ChangeToken, db=Depends(orm.get_session)):
     return await service.change_token(db, data)
 
 
+@router.post("/logout_all",
+             summary="Выйти со всех устройств",
+             description="Отзывает все refresh токены пользователя. Выданные access токены действуют до истечения",
+             response_model=SuccessResponse,
+             tags=["Token"])
+async def logout_all(token: HTTPAuthorizationCredentials = Depends(security), db=Depends(orm.get_session)):
+    token = await verify_jwt_token(token)
+    return await service.revoke_user_tokens(db, token['id'])
+
+
+@router.post("/introspect",
+             summary="Проверить пачку токенов",
+             description="RFC 7662: для каждого access/refresh токена возвращает active, expired и claims. "
+                         "Доступно ролям admin и service",
+             response_model=IntrospectOutput,
+             tags=["Token"])
+async def introspect(data: IntrospectRequest,
+                     token: dict = Depends(rbac.require_permission("tokens:introspect")),
+                     db=Depends(orm.get_session)):
+    return await service.introspect_tokens(db, data)
+
+
 @router.post("/auth/telegram/get_code/phone",
              summary="Запросить код для авторизации в Telegram по номеру телефона",
              description="Получишь code_id, его нужно будет ввести вместе с кодом в методе подтверждения. "
@@ -178,6 +228,24 @@ async def auth_telegram_confirm_email(data: AuthConfirmEmailTelegram, db=Depends
     return await service.auth_telegram_confirm(db, data)
 
 
+@router.post("/auth/telegram/login",
+             summary="Войти по telegram_id",
+             description="Работает после привязки telegram_id в методах подтверждения, код не нужен",
+             tags=["Telegram"],
+             response_model=AuthOutput)
+async def auth_telegram_login(data: AuthTelegramLogin, db=Depends(orm.get_session)):
+    return await service.auth_telegram_login(db, data)
+
+
+@router.post("/auth/telegram/confirm_batch",
+             summary="Пакетное подтверждение кодов для Telegram",
+             description="Принимает пары phone_number/email + код, результат для каждой пары в порядке запроса",
+             tags=["Telegram"],
+             response_model=AuthTelegramBatchOutput)
+async def auth_telegram_confirm_batch(data: AuthTelegramBatchConfirm, db=Depends(orm.get_session)):
+    return await service.auth_telegram_batch_confirm(db, data)
+
+
 @router.get("/auth/qr",
             summary="Запросить QR-код",
             description="Запрашиваешь QR-код. выводишь его на экран. Отправляешь lp-запрос по вернувшемуся адресу",
@@ -187,7 +255,10 @@ async def auth_qr_get_code(db=Depends(orm.get_session)):
     return await service.get_qr_code_info(db)
 
 
-@router.get("/qr_code/auth/{hashed}", summary="Переход по ссылке авторизованным пользователем", tags=["QR"])
+@router.get("/qr_code/auth/{hashed}",
+            summary="Переход по ссылке авторизованным пользователем",
+            response_model=SuccessResponse,
+            tags=["QR"])
 async def qr_code_auth(hashed: str,
                        db: AsyncSession = Depends(orm.get_session),
                        token: HTTPAuthorizationCredentials = Depends(security)):
@@ -195,20 +266,153 @@ async def qr_code_auth(hashed: str,
     return await service.qr_code_auth(db, token['id'], hashed)
 
 
-@router.get("/qr/longpoll/{hashed}", summary='Лонгпулл QR. Ждем пока пользователь перейдет по ссылке', tags=["QR"])
+@router.get("/qr/longpoll/{hashed}",
+            summary='Лонгпулл QR. Ждем пока пользователь перейдет по ссылке',
+            response_model=AuthOutput,
+            tags=["QR"])
 async def qr_longpoll(hashed: str, db=Depends(orm.get_session)):
     return await service.qr_longpoll(db, hashed)
 
 
 @router.get("/users/me",
             summary="Получить информацию о себе",
+            response_model=UserOutput,
+            tags=["Users"])
+async def users_me(token: HTTPAuthorizationCredentials = Depends(security),
+                   db=Depends(orm.get_session),
+                   if_none_match: Optional[str] = Header(None)):
+    token = await verify_jwt_token(token)
+    return await service.users_me(db, token['id'], if_none_match)
+
+
+@router.get("/users/me/logins",
+            summary="История входов",
+            description="Входы, refresh, подтверждения QR и неверные коды от новых к старым. "
+                        "В следующий запрос передай next_before_id из ответа",
+            response_model=LoginEventsPageOutput,
             tags=["Users"])
-async def users_me(token: HTTPAuthorizationCredentials = Depends(security), db=Depends(orm.get_session)):
+async def my_login_history(before_id: Optional[int] = Query(None, ge=1),
+                           limit: int = Query(50, ge=1, le=500),
+                           token: HTTPAuthorizationCredentials = Depends(security)):
     token = await verify_jwt_token(token)
-    return await service.users_me(db, token['id'])
+    return await service.get_login_history(token['id'], before_id, limit)
+
+
+@router.get("/users/{user_id}/logins",
+            summary="История входов пользователя",
+            description="То же, что /users/me/logins, для любого пользователя. Только для admin",
+            response_model=LoginEventsPageOutput,
+            tags=["Users"])
+async def user_login_history(user_id: int,
+                             before_id: Optional[int] = Query(None, ge=1),
+                             limit: int = Query(50, ge=1, le=500),
+                             token: dict = Depends(rbac.require_permission("logins:read"))):
+    return await service.get_login_history(user_id, before_id, limit)
+
 
+USERS_EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
 
 
+@router.get("/users",
+            summary="Список пользователей постранично",
+            description="Keyset-пагинация: в следующий запрос передай next_after_id из ответа. Только для admin",
+            response_model=UsersPageOutput,
+            tags=["Users"])
+async def get_users(after_id: int = Query(0, ge=0),
+                    limit: int = Query(100, ge=1, le=1000),
+                    token: dict = Depends(rbac.require_permission("users:read")),
+                    db=Depends(orm.get_session)):
+    return await service.get_users_page(db, after_id, limit)
+
+
+@router.post("/users/by_ids",
+             summary="Получить пользователей по списку id",
+             description="Один запрос вместо N вызовов. Отсутствующие id пропускаются. Только для admin",
+             response_model=UsersListOutput,
+             tags=["Users"])
+async def get_users_by_ids(data: UsersByIds,
+                           token: dict = Depends(rbac.require_permission("users:read")),
+                           db=Depends(orm.get_session)):
+    return await service.get_users_by_ids(db, data.ids)
+
+
+@router.get("/users/export",
+            summary="Выгрузить всех пользователей",
+            description="Потоковая выгрузка в NDJSON или CSV. Только для admin",
+            tags=["Users"])
+async def export_users(export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+                       token: dict = Depends(rbac.require_permission("users:read"))):
+    return StreamingResponse(service.export_users(export_format),
+                             media_type=USERS_EXPORT_MEDIA_TYPES[export_format],
+                             headers={"Content-Disposition": f"attachment; filename=users.{export_format}"})
+
+
+@router.post("/files",
+             summary="Загрузить файл",
+             description="Тело запроса - содержимое файла, тип - из Content-Type. Одинаковые файлы хранятся один раз",
+             response_model=FileOutput,
+             tags=["Files"])
+async def upload_file(request: Request,
+                      name: str = Query(..., max_length=255),
+                      token: HTTPAuthorizationCredentials = Depends(security),
+                      db=Depends(orm.get_session)):
+    token = await verify_jwt_token(token)
+    content_type = request.headers.get("content-type", "application/octet-stream")
+    return await service.upload_file(db, token['id'], name, content_type, request.stream())
+
+
+@router.get("/files",
+            summary="Мои файлы",
+            response_model=FilesPageOutput,
+            tags=["Files"])
+async def list_files(after_id: int = Query(0, ge=0),
+                     limit: int = Query(100, ge=1, le=1000),
+                     token: HTTPAuthorizationCredentials = Depends(security),
+                     db=Depends(orm.get_session)):
+    token = await verify_jwt_token(token)
+    return await service.list_files(db, token['id'], after_id, limit)
+
+
+@router.get("/files/{file_id}",
+            summary="Скачать файл",
+            description="Поддерживает Range и If-None-Match",
+            tags=["Files"])
+async def download_file(file_id: int,
+                        token: HTTPAuthorizationCredentials = Depends(security),
+                        db=Depends(orm.get_session),
+                        range_header: Optional[str] = Header(None, alias="Range"),
+                        if_none_match: Optional[str] = Header(None)):
+    token = await verify_jwt_token(token)
+    return await service.download_file(db, token['id'], file_id, range_header, if_none_match)
+
+
+@router.delete("/files/{file_id}",
+               summary="Удалить файл",
+               response_model=SuccessResponse,
+               tags=["Files"])
+async def delete_file(file_id: int,
+                      token: HTTPAuthorizationCredentials = Depends(security),
+                      db=Depends(orm.get_session)):
+    token = await verify_jwt_token(token)
+    return await service.delete_file(db, token['id'], file_id)
+
 
+@router.get("/diagnostics",
+            summary="Диагностика event loop",
+            description="Задержки loop, стеки блокирующих вызовов, выборочный профиль запросов, "
+                        "статистика склеивания одинаковых запросов (single_flight). Только для admin",
+            tags=["Diagnostics"])
+async def get_diagnostics(token: dict = Depends(rbac.require_permission("diagnostics:read"))):
+    return diagnostics.report()
 
 
+@router.get("/outbox",
+            summary="Очередь доставки кодов",
+            description="Глубина очереди outbox и задержка доставки. Только для admin",
+            tags=["Diagnostics"])
+async def get_outbox_stats(token: dict = Depends(rbac.require_permission("diagnostics:read")),
+                           db=Depends(orm.get_session)):
+    return await outbox.stats(db)
@@ -1,7 +1,36 @@
+import re
 from datetime import date, datetime
-from typing import Optional, Literal
+from typing import Optional, Literal, Annotated
 
-from pydantic import BaseModel, Field, EmailStr, validator, field_validator, ConfigDict
+from pydantic import BaseModel, Field, EmailStr, validator, ConfigDict, AfterValidator
+
+
+def normalize_phone(v: str) -> str:
+    """
+    Приводит номер к E.164 без '+': убирает пробелы, скобки, дефисы.
+    Российские 8XXXXXXXXXX и 9XXXXXXXXX переводятся в 7XXXXXXXXXX
+    """
+    digits = re.sub(r"[\s()\-.]", "", v).removeprefix("+")
+    if not digits.isdigit():
+        raise ValueError('Phone number must be digits only')
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    elif len(digits) == 10 and digits.startswith("9"):
+        digits = "7" + digits
+    if not 10 <= len(digits) <= 15:
+        raise ValueError('Phone number must contain 10-15 digits')
+    return digits
+
+
+def normalize_email(v: str) -> str:
+    """Локальная часть в нижнем регистре, домен в IDNA (punycode) в нижнем регистре"""
+    local, _, domain = v.rpartition("@")
+    return local.lower() + "@" + domain.encode("idna").decode("ascii").lower()
+
+
+# Контакты нормализуются при разборе запроса: в БД пишется и по индексу ищется одна форма
+PhoneNumber = Annotated[str, AfterValidator(normalize_phone)]
+Email = Annotated[EmailStr, AfterValidator(normalize_email)]
 
 
 class UserCreate(BaseModel):
@@ -15,18 +44,12 @@ class UserCreate(BaseModel):
 
 class UserCreatePhoneRequest(UserCreate):
     """Запрос на создание пользователя по номеру телефона"""
-    phone_number: str = Field(..., example="79493686568")
-
-    @field_validator('phone_number')
-    def phone_number_must_be_valid(cls, v):
-        if v and not v.isdigit():
-            raise ValueError('Phone number must be digits only')
-        return v
+    phone_number: PhoneNumber = Field(..., example="79493686568")
 
 
 class UserCreateEmailRequest(UserCreate):
     """Запрос на создание пользователя по почте"""
-    email: EmailStr = Field(..., example="a2004@webcam.com")
+    email: Email = Field(..., example="a2004@webcam.com")
 
 
 class SuccessResponse(BaseModel):
@@ -41,23 +64,17 @@ class UserCreateResponse(SuccessResponse):
 
 class Confirm(BaseModel):
     code_id: int
-    code: int
+    code: int = Field(..., example=123456)
 
 
 class RegistrationPhoneConfirm(Confirm):
     """Подтверждение регистрации по Phone"""
-    phone_number: str = Field(..., example="79493686568")
-
-    @field_validator('phone_number')
-    def phone_number_must_be_valid(cls, v):
-        if v and not v.isdigit():
-            raise ValueError('Phone number must be digits only')
-        return v
+    phone_number: PhoneNumber = Field(..., example="79493686568")
 
 
 class RegistrationEmailConfirm(Confirm):
     """Подтверждение регистрации по email"""
-    email: EmailStr = Field(..., example="a2004@webcam.com")
+    email: Email = Field(..., example="a2004@webcam.com")
 
 
 class RegistrationResponse(SuccessResponse):
@@ -66,17 +83,11 @@ class RegistrationResponse(SuccessResponse):
 
 
 class AuthGetCodeByPhone(BaseModel):
-    phone_number: str = Field(..., example="79493686568")
-
-    @field_validator('phone_number')
-    def phone_number_must_be_valid(cls, v):
-        if v and not v.isdigit():
-            raise ValueError('Phone number must be digits only')
-        return v
+    phone_number: PhoneNumber = Field(..., example="79493686568")
 
 
 class AuthGetCodeByEmail(BaseModel):
-    email: EmailStr = Field(..., example="a2004@webcam.com")
+    email: Email = Field(..., example="a2004@webcam.com")
 
 
 class AuthTelegram(BaseModel):
@@ -96,48 +107,84 @@ class AuthGetOutput(SuccessResponse):
 
 class AuthConfirm(BaseModel):
     code_id: int = Field(..., example=1)
-    code: int = Field(..., example=11111)
+    code: int = Field(..., example=123456)
 
 
 class AuthConfirmPhone(AuthConfirm):
-    phone_number: str = Field(..., example="79493686568")
+    phone_number: PhoneNumber = Field(..., example="79493686568")
 
 
 class AuthConfirmEmail(AuthConfirm):
-    email: EmailStr = Field(..., example="a2004@webcam.com")
+    email: Email = Field(..., example="a2004@webcam.com")
+
 
+class TelegramLink(BaseModel):
+    """telegram_id привязывается к пользователю при подтверждении, дальше вход по /auth/telegram/login"""
+    telegram_id: Optional[int] = Field(None, example=123456789)
 
-class AuthConfirmPhoneTelegram(AuthConfirmPhone, AuthTelegram):
+
+class AuthConfirmPhoneTelegram(AuthConfirmPhone, AuthTelegram, TelegramLink):
     pass
 
-class AuthConfirmEmailTelegram(AuthConfirmEmail, AuthTelegram):
+class AuthConfirmEmailTelegram(AuthConfirmEmail, AuthTelegram, TelegramLink):
     pass
 
 
+class AuthTelegramLogin(AuthTelegram):
+    telegram_id: int = Field(..., example=123456789)
+
+
 class AuthOutput(SuccessResponse):
     access_token: str
     refresh_token: str
 
 
+class AuthTelegramBatchItem(AuthConfirm):
+    """Передается phone_number либо email"""
+    phone_number: Optional[PhoneNumber] = Field(None, example="79493686568")
+    email: Optional[Email] = Field(None, example="a2004@webcam.com")
+
+
+class AuthTelegramBatchConfirm(AuthTelegram):
+    items: list[AuthTelegramBatchItem] = Field(..., min_length=1, max_length=500)
+
+
+class AuthTelegramBatchItemOutput(BaseModel):
+    status: bool
+    access_token: Optional[str] = None
+    error: Optional[str] = None
+
+
+class AuthTelegramBatchOutput(SuccessResponse):
+    """Результаты в порядке items запроса"""
+    results: list[AuthTelegramBatchItemOutput]
+
+
 class ChangeToken(BaseModel):
     refresh_token: str
 
 
 class ChangeTokenOutput(SuccessResponse):
+    """refresh_token - новый токен, переданный в запросе больше не действует"""
     access_token: str
+    refresh_token: str
 
 
-class UserOutput(SuccessResponse):
+class UserRow(BaseModel):
+    """Поля соответствуют столбцам users: отчество, пол и дата рождения при регистрации необязательны"""
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     first_name: str
     last_name: str
-    middle_name: str
-    gender: int
+    middle_name: Optional[str] = None
+    gender: Optional[int] = None
     email: Optional[str] = None
-    phone: Optional[str] = None
-    birth_date: datetime
+    phone_number: Optional[str] = None
+    birth_date: Optional[date] = None
 
 
+class UserOutput(UserRow, SuccessResponse):
     class Config:
         orm_mode = True
 
@@ -146,6 +193,74 @@ class GetQROutput(SuccessResponse):
     token: str
     url: str
 
+
+class FileOutput(SuccessResponse):
+    id: int
+    name: str
+    hash: str
+    type: str
+    size: Optional[int] = None
+    create_date: datetime
+
+
+class FilesPageOutput(SuccessResponse):
+    """next_after_id передается в следующий запрос, None - страниц больше нет"""
+    files: list[FileOutput]
+    next_after_id: Optional[int] = None
+
+
+class IntrospectToken(BaseModel):
+    token: str
+    token_type_hint: Optional[Literal["access_token", "refresh_token"]] = None
+
+
+class IntrospectRequest(BaseModel):
+    """Пакетная проверка токенов (RFC 7662)"""
+    tokens: list[IntrospectToken] = Field(..., min_length=1, max_length=1000)
+
+
+class TokenIntrospection(BaseModel):
+    active: bool
+    expired: bool = False
+    token_type: Optional[Literal["access_token", "refresh_token"]] = None
+    user_id: Optional[int] = None
+    roles: Optional[list[str]] = None
+    exp: Optional[int] = None
+
+
+class IntrospectOutput(SuccessResponse):
+    """Результаты в порядке токенов запроса"""
+    tokens: list[TokenIntrospection]
+
+
+class UsersByIds(BaseModel):
+    """Запрос пачки пользователей по id"""
+    ids: list[int] = Field(..., min_length=1, max_length=1000, example=[1, 2, 3])
+
+
+class UsersListOutput(SuccessResponse):
+    users: list[UserOutput]
+
+
+class UsersPageOutput(UsersListOutput):
+    """Страница пользователей. next_after_id передается в следующий запрос, None - страниц больше нет"""
+    next_after_id: Optional[int] = None
+
+
+class LoginEventOutput(BaseModel):
+    id: int
+    event: str
+    detail: Optional[str] = None
+    request_id: Optional[str] = None
+    created_at: datetime
+    model_config = ConfigDict(from_attributes=True)
+
+
+class LoginEventsPageOutput(SuccessResponse):
+    """История входов от новых к старым. next_before_id передается в следующий запрос, None - страниц больше нет"""
+    events: list[LoginEventOutput]
+    next_before_id: Optional[int] = None
+
 # class UserCreateRequest(BaseModel):
 #     name: str = Field(max_length=30)
 #     fullname: str
@@ -1,19 +1,33 @@
 import asyncio
-import os
+import calendar
+import csv
+import hashlib
+import io
+import secrets
+import time
 from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional
 
 from fastapi import HTTPException
-from sqlalchemy import select, update, or_
-from sqlalchemy.exc import IntegrityError
+from jose import jwt
+from sqlalchemy import select, update, insert, literal, or_, and_, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import JSONResponse
+from starlette.responses import Response
 
-from orm import db_manager
-from src.models import User, VerificationCode, UserRoles, Role, RefreshToken, QRAuthTokens
+from config import get_settings
+from orm import db_manager, shard_router
+from src.files import store_stream, parse_range, RangeFileResponse
+from src.models import User, VerificationCode, UserRoles, RefreshToken, QRAuthTokens, File, LoginEvent
 from src.schemas import UserCreatePhoneRequest, UserCreateResponse, UserCreateEmailRequest, RegistrationPhoneConfirm, \
     RegistrationResponse, SuccessResponse, AuthGetOutput, AuthOutput, ChangeToken, ChangeTokenOutput, UserOutput, \
-    GetQROutput
-from src.utils import create_refresh_token, create_access_token, QRCodeGenerator
+    GetQROutput, UserRow, UsersListOutput, UsersPageOutput, IntrospectRequest, IntrospectOutput, TokenIntrospection, \
+    AuthTelegramBatchConfirm, AuthTelegramBatchOutput, AuthTelegramBatchItemOutput, AuthTelegramLogin, FileOutput, \
+    FilesPageOutput, LoginEventOutput, LoginEventsPageOutput
+from src import audit, identity, outbox, rbac
+from src.cache import LRUCache, SingleFlight
+from src.utils import create_refresh_token, create_access_token, QRCodeGenerator, decode_jwt_token, \
+    hash_refresh_token, issue_refresh_token, refresh_token_shard
 
 VERIFICATION_TYPES = {
     "registration_phone": "registration_phone",
@@ -22,80 +36,195 @@ VERIFICATION_TYPES = {
     "auth_email": "auth_email"
 }
 
-
-async def create_user(data, db: AsyncSession):
+REGISTRATION_VERIFICATION_TYPES = (VERIFICATION_TYPES['registration_phone'], VERIFICATION_TYPES['registration_email'])
+AUTH_VERIFICATION_TYPES = (VERIFICATION_TYPES['auth_phone'], VERIFICATION_TYPES['auth_email'])
+VERIFICATION_CODE_LIFETIME = timedelta(minutes=5)
+CODE_LOCKED_ERROR = "Превышено число попыток ввода кода. Запросите новый"
+
+USERS_EXPORT_BATCH_SIZE = 1000
+# Роль "user" создается при старте (main.lifespan) и выдается при подтверждении регистрации
+USER_ROLE_ID = 1
+TELEGRAM_ACCESS_TOKEN_EXPIRE = timedelta(days=365*30)
+
+# telegram_id -> user_id активного пользователя. Привязка меняется в link_telegram_id, в том числе
+# в соседних воркерах: auth_telegram_login перепроверяет ее запросом ролей
+telegram_users = LRUCache(maxsize=100000)
+# user_id -> (тело ответа /users/me, ETag). Сбрасывается при каждом UPDATE users,
+# ttl ограничивает устаревание в соседних воркерах
+users_me_cache = LRUCache(maxsize=100000, ttl=60)
+# code_id -> число неверных попыток. Живет не дольше самого кода
+code_attempts = LRUCache(maxsize=100000, ttl=VERIFICATION_CODE_LIFETIME.total_seconds())
+# Одновременные одинаковые запросы в БД выполняются один раз, статистика - в /api/diagnostics
+contact_lookups = SingleFlight("get_user_by_contact")
+users_me_loads = SingleFlight("users_me")
+# Вкладки опрашивают QR раз в секунду не синхронно: результат опроса отдается всем еще полсекунды
+qr_polls = SingleFlight("qr_longpoll", window=0.5)
+# Опросы QR занимают не больше стольких соединений пула одновременно, сколько бы ни было ожидающих
+QR_POLL_CONNECTIONS = 3
+qr_poll_slots = asyncio.Semaphore(QR_POLL_CONNECTIONS)
+
+
+def pending_user_upsert(data):
     """
-    Пытается добавить юзера, отдает 403, если что-то повторяется(email, phone)
-    :param data:
-    :param db:
-    :return: User
+    INSERT ... ON CONFLICT по контакту (uq__users__phone_number / uq__users__email): повторная регистрация
+    неподтвержденного контакта переписывает ту же строку. Для подтвержденного контакта строка не возвращается
+    :param data: UserCreatePhoneRequest или UserCreateEmailRequest
+    :return: insert ... RETURNING users.id
     """
-    user = User(**data.model_dump())
-    try:
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
-        return user
-    except IntegrityError:
-        raise HTTPException(403, "Пользователь уже зарегистрирован. Подтвердите регистрацию либо воспользуйтесь методом авторизации")
+    if hasattr(data, 'phone_number'):
+        contact = User.phone_number
+    elif hasattr(data, 'email'):
+        contact = User.email
+    else:
+        raise HTTPException(400, "E-mail или phone_number не переданы")
+    values = data.model_dump() | {"is_active": False, "created_at": datetime.utcnow()}
+    statement = pg_insert(User).values(**values)
+    return (statement
+            .on_conflict_do_update(index_elements=[contact], index_where=contact.isnot(None),
+                                   set_={key: statement.excluded[key] for key in values},
+                                   where=User.is_active == False)
+            .returning(User.id))
 
 
 def code_generator():
-    return 11111
-    # return random.randint(101010, 909090)
+    """Случайный 6-значный код из криптографического генератора"""
+    return 100000 + secrets.randbelow(900000)
+
+
+def check_code_attempts(code_id: int):
+    """Заблокированный код отклоняется без запроса в БД"""
+    if code_attempts.get(code_id, 0) >= get_settings().CODE_MAX_ATTEMPTS:
+        raise HTTPException(429, CODE_LOCKED_ERROR)
 
 
-async def generate_security_code(db: AsyncSession, user_id: int, verification_type: str):
+async def register_failed_attempts(db: AsyncSession, codes: list[tuple[int, int]]):
+    """
+    Увеличивает счетчики неверных попыток. Считается только неверный код, выданный владельцу
+    переданного контакта: подбор code_id с чужим или незарегистрированным контактом не блокирует коды.
+    При CODE_ATTEMPTS_PERSIST счетчик пишется и в БД, код с исчерпанными попытками деактивируется для всех воркеров
+    :param db:
+    :param codes: пары (code_id, user_id владельца контакта)
+    :return:
+    """
+    settings = get_settings()
+    shard_codes: dict[int, list[tuple[int, int]]] = {}
+    for code_id, user_id in codes:
+        code_attempts.set(code_id, code_attempts.get(code_id, 0) + 1)
+        shard_id, local_id = shard_router.split_id(code_id)
+        shard_codes.setdefault(shard_id, []).append((local_id, user_id))
+    if not settings.CODE_ATTEMPTS_PERSIST:
+        return
+    for shard_id, pairs in shard_codes.items():
+        async with shard_router.session(shard_id, db) as shard_db:
+            await shard_db.execute(update(VerificationCode)
+                                   .where(tuple_(VerificationCode.id, VerificationCode.user_id).in_(pairs))
+                                   .values(attempts=VerificationCode.attempts + 1,
+                                           is_active=and_(VerificationCode.is_active == True,
+                                                          VerificationCode.attempts + 1 < settings.CODE_MAX_ATTEMPTS))
+                                   .execution_options(synchronize_session=False))
+            await shard_db.commit()
+
+
+async def generate_security_code(db: AsyncSession, user_id: int, verification_type: str, data) -> int:
     """
-    Создает код на 5 минут
+    Создает код на 5 минут в шарде пользователя, в той же транзакции ставит его в outbox на доставку
     :param db:
     :param user_id:
     :param verification_type:
-    :param expires_at:
-    :return:
+    :param data: запрос с phone_number либо email - куда отправить код
+    :return: code_id
     """
-    expires_at: datetime = datetime.utcnow() + timedelta(minutes=5)
+    expires_at: datetime = datetime.utcnow() + VERIFICATION_CODE_LIFETIME
     verification = VerificationCode(user_id=user_id, verification_type=verification_type, expires_at=expires_at,
                                     code=code_generator())
+    shard_id = shard_router.shard_id_for_user(user_id)
     try:
-        db.add(verification)
-        await db.commit()
-        await db.refresh(verification)
-        return verification
+        async with shard_router.session(shard_id, db) as shard_db:
+            shard_db.add(verification)
+            outbox.enqueue_code(shard_db, data, verification.code, expires_at)
+            await shard_db.commit()
+        return shard_router.global_id(shard_id, verification.id)
     except Exception as e:
         raise HTTPException(403, e.__str__())
 
 
-async def user_exists_and_active(db: AsyncSession, data):
+def code_shard(code_id: int) -> tuple[int, int]:
     """
-    Возвращает True если User существует и подтвердил регистрацию
-    :param db:
-    :param data:
-    :return:
+    Шард кода по code_id из запроса
+    :param code_id:
+    :return: (номер шарда, id кода в шарде)
     """
-    if hasattr(data, 'phone_number'):
-        user = await db.execute(select(User).where(User.phone_number == data.phone_number,
-                                                   User.is_active==True))
-    elif hasattr(data, 'email'):
-        user = await db.execute(select(User).where(User.email == data.email,
-                                                   User.is_active == True))
-    else:
-        raise HTTPException(400, "E-mail или phone_number не переданы")
+    shard_id, local_id = shard_router.split_id(code_id)
+    if not shard_router.has_shard(shard_id):
+        raise HTTPException(404, "Код подтверждения не верен либо не найден")
+    return shard_id, local_id
 
-    user = user.fetchone()
-    if user:
-        return True
-    return False
+
+def verification_code_insert(user_id, verification_type: str, code: int, expires_at: datetime, now: datetime):
+    """
+    Отзыв прежних активных кодов пользователя того же типа и новый код одним запросом
+    :param user_id: выражение с id пользователя: literal либо столбец CTE
+    :param verification_type:
+    :param code:
+    :param expires_at:
+    :param now:
+    :return: insert ... RETURNING verification_codes.id
+    """
+    revoked_codes = (update(VerificationCode)
+                     .where(VerificationCode.user_id.in_(select(user_id)),
+                            VerificationCode.verification_type == verification_type,
+                            VerificationCode.is_active == True)
+                     .values(is_active=False)
+                     .returning(VerificationCode.id)
+                     .cte("revoked_codes"))
+    return (insert(VerificationCode)
+            .from_select(["user_id", "verification_type", "code", "expires_at", "created_at", "is_active",
+                          "attempts"],
+                         select(user_id, literal(verification_type), literal(code), literal(expires_at),
+                                literal(now), literal(True), literal(0)))
+            .add_cte(revoked_codes)
+            .returning(VerificationCode.id))
 
 
 async def register_user(data, db, verification_type):
-    if await user_exists_and_active(db, data):
+    """
+    Регистрация одним запросом: upsert неподтвержденного пользователя, отзыв его прежних кодов регистрации
+    и новый код. Сколько бы раз контакт ни регистрировался, строка пользователя одна.
+    Код ставится в outbox в той же транзакции.
+    При DATABASE_SHARD_URLS коды в шарде пользователя: сначала upsert в основной БД, затем код в шарде
+    :param data:
+    :param db:
+    :param verification_type:
+    :return:
+    """
+    key = identity.contact_key(data)
+    if key is not None and identity.get_active(key):
         raise HTTPException(401, "Пользователь зарегистрирован. Воспользуйтесь методами авторизации.")
-    user = await create_user(data, db)
-    user_id = user.id
-    verification = await generate_security_code(db, user_id, verification_type)
-    response = UserCreateResponse(code_id=verification.id).model_dump(mode='json')
-    return JSONResponse(response)
+
+    now = datetime.utcnow()
+    expires_at = now + VERIFICATION_CODE_LIFETIME
+    code = code_generator()
+    if shard_router.sharded:
+        user_id = (await db.execute(pending_user_upsert(data))).scalar_one_or_none()
+        if user_id is None:
+            raise HTTPException(401, "Пользователь зарегистрирован. Воспользуйтесь методами авторизации.")
+        await db.commit()
+        shard_id = shard_router.shard_id_for_user(user_id)
+        async with shard_router.session(shard_id) as shard_db:
+            local_id = (await shard_db.execute(verification_code_insert(literal(user_id), verification_type, code,
+                                                                        expires_at, now))).scalar_one()
+            outbox.enqueue_code(shard_db, data, code, expires_at)
+    else:
+        user = pending_user_upsert(data).cte("registered_user")
+        shard_id = 0
+        local_id = (await db.execute(verification_code_insert(user.c.id, verification_type, code,
+                                                              expires_at, now))).scalar_one_or_none()
+        if local_id is None:
+            raise HTTPException(401, "Пользователь зарегистрирован. Воспользуйтесь методами авторизации.")
+        outbox.enqueue_code(db, data, code, expires_at)
+        await db.commit()
+    identity.add_contacts(getattr(data, 'phone_number', None), getattr(data, 'email', None))
+    return UserCreateResponse(code_id=shard_router.global_id(shard_id, local_id))
 
 
 async def registration_by_phone(data: UserCreatePhoneRequest, db: AsyncSession):
@@ -108,20 +237,112 @@ async def registration_by_email(data: UserCreateEmailRequest, db: AsyncSession):
     return await register_user(data, db, VERIFICATION_TYPES['registration_email'])
 
 
-async def get_user_by_phone(phone_number: str, db: AsyncSession):
-    user = await db.execute(select(User).where(User.phone_number == phone_number).order_by(User.created_at.desc()).limit(1))
-    user = user.fetchone()
+async def get_user_by_contact(db: AsyncSession, key: str, condition) -> identity.Identity:
+    """
+    Пользователь с контактом (контакт уникален). Незарегистрированные контакты
+    отсекаются Bloom-фильтром, активные пользователи берутся из кэша
+    :param db:
+    :param key: ключ контакта identity.contact_key
+    :param condition: условие на users для промаха кэша
+    :return: Identity(id, is_active)
+    """
+    if identity.is_unregistered(key):
+        raise HTTPException(404, "Пользователь не зарегистрирован")
+    user = identity.get_active(key)
+    if user is not None:
+        return user
+    user = await contact_lookups.do(key, lambda: lookup_contact(db, condition))
     if not user:
         raise HTTPException(404, "Пользователь не зарегистрирован")
-    return user[0]
+    if user.is_active:
+        identity.remember_active(key, user.id)
+    return user
 
 
-async def get_user_by_email(email: str, db: AsyncSession):
-    user = await db.execute(select(User).where(User.email == email).order_by(User.created_at.desc()).limit(1))
+async def lookup_contact(db: AsyncSession, condition) -> Optional[identity.Identity]:
+    user = await db.execute(select(User.id, User.is_active).where(condition))
     user = user.fetchone()
-    if not user:
-        raise HTTPException(404, "Пользователь не зарегистрирован")
-    return user[0]
+    return identity.Identity(user.id, user.is_active) if user else None
+
+
+async def get_user_by_phone(phone_number: str, db: AsyncSession):
+    return await get_user_by_contact(db, identity.phone_key(phone_number), User.phone_number == phone_number)
+
+
+async def get_user_by_email(email: str, db: AsyncSession):
+    return await get_user_by_contact(db, identity.email_key(email), User.email == email)
+
+
+async def get_users_page(db: AsyncSession, after_id: int = 0, limit: int = 100):
+    """
+    Keyset-пагинация по первичному ключу: WHERE id > after_id ORDER BY id LIMIT limit
+    :param db:
+    :param after_id: id последнего пользователя предыдущей страницы
+    :param limit:
+    :return: UsersPageOutput
+    """
+    users = await db.scalars(select(User).where(User.id > after_id).order_by(User.id).limit(limit))
+    users = [UserOutput.model_validate(user) for user in users.all()]
+    next_after_id = users[-1].id if len(users) == limit else None
+    return UsersPageOutput(users=users, next_after_id=next_after_id)
+
+
+async def get_login_history(user_id: int, before_id: Optional[int] = None, limit: int = 50):
+    """
+    История входов пользователя от новых к старым, keyset-пагинация по индексу (user_id, id).
+    Читается из шарда пользователя. События последней секунды могут быть еще в буфере src.audit
+    :param user_id:
+    :param before_id: id последнего события предыдущей страницы
+    :param limit:
+    :return: LoginEventsPageOutput
+    """
+    query = select(LoginEvent).where(LoginEvent.user_id == user_id)
+    if before_id is not None:
+        query = query.where(LoginEvent.id < before_id)
+    async with shard_router.session_for_user(user_id) as db:
+        events = await db.scalars(query.order_by(LoginEvent.id.desc()).limit(limit))
+        events = [LoginEventOutput.model_validate(event) for event in events.all()]
+    next_before_id = events[-1].id if len(events) == limit else None
+    return LoginEventsPageOutput(events=events, next_before_id=next_before_id)
+
+
+async def get_users_by_ids(db: AsyncSession, ids: list[int]):
+    """
+    Возвращает пользователей одним IN-запросом. Отсутствующие id пропускаются
+    :param db:
+    :param ids:
+    :return: UsersListOutput
+    """
+    users = await db.scalars(select(User).where(User.id.in_(set(ids))).order_by(User.id))
+    return UsersListOutput(users=[UserOutput.model_validate(user) for user in users.all()])
+
+
+async def export_users(export_format: str = "ndjson") -> AsyncIterator[bytes]:
+    """
+    Выгружает всех пользователей (UserRow, без status ответа) через серверный курсор,
+    память ограничена USERS_EXPORT_BATCH_SIZE строками.
+    Сессия открывается внутри генератора: зависимость get_session закрывается до отправки ответа
+    :param export_format: ndjson | csv
+    :return:
+    """
+    query = select(User).order_by(User.id).execution_options(yield_per=USERS_EXPORT_BATCH_SIZE)
+    fields = list(UserRow.model_fields)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    if export_format == "csv":
+        writer.writeheader()
+        yield buffer.getvalue().encode()
+
+    async with db_manager.session() as session:
+        users = await session.stream_scalars(query)
+        async for partition in users.partitions():
+            if export_format == "csv":
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(UserRow.model_validate(user).model_dump(mode='json') for user in partition)
+                yield buffer.getvalue().encode()
+            else:
+                yield "".join(UserRow.model_validate(user).model_dump_json() + "\n" for user in partition).encode()
 
 
 async def get_user_by_id(id: int, db: AsyncSession):
@@ -132,67 +353,134 @@ async def get_user_by_id(id: int, db: AsyncSession):
     return user[0]
 
 
-async def get_verification_data(db: AsyncSession, data):
+def contact_user_id_subquery(data):
+    """
+    id пользователя по phone_number/email как в get_user_by_*, в виде подзапроса
+    :param data:
+    :return:
+    """
     if hasattr(data, 'phone_number'):
-        user = await get_user_by_phone(data.phone_number, db)
+        condition = User.phone_number == data.phone_number
     elif hasattr(data, 'email'):
-        user = await get_user_by_email(data.email, db)
+        condition = User.email == data.email
     else:
         raise HTTPException(400, "Не переданы email или phone_number")
+    return select(User.id).where(condition).scalar_subquery()
 
-    user_id = user.id
-    verification = await db.execute(select(VerificationCode).where(VerificationCode.id == data.code_id,
-                                                                   user_id == VerificationCode.user_id,
-                                                                   or_(
-                                                                       VerificationCode.verification_type ==
-                                                                       VERIFICATION_TYPES['registration_phone'],
-                                                                       VerificationCode.verification_type ==
-                                                                       VERIFICATION_TYPES['registration_email']
-                                                                   ),
-                                                                   VerificationCode.is_active==True).limit(1))
+
+async def get_contact_user(db: AsyncSession, data) -> identity.Identity:
+    if hasattr(data, 'phone_number'):
+        return await get_user_by_phone(data.phone_number, db)
+    elif hasattr(data, 'email'):
+        return await get_user_by_email(data.email, db)
+    else:
+        raise HTTPException(400, "Не переданы email или phone_number")
+
+
+async def get_verification(db: AsyncSession, shard_db: AsyncSession, data, verification_types: tuple):
+    """
+    :param db: сессия основной БД, владелец контакта
+    :param shard_db: сессия шарда кода
+    :param data:
+    :param verification_types:
+    :return:
+    """
+    user_id = (await get_contact_user(db, data)).id
+    _, code_id = shard_router.split_id(data.code_id)
+    verification = await shard_db.execute(select(VerificationCode).where(VerificationCode.id == code_id,
+                                                                         user_id == VerificationCode.user_id,
+                                                                         VerificationCode.verification_type.in_(
+                                                                             verification_types),
+                                                                         VerificationCode.is_active==True).limit(1))
     verification = verification.fetchone()
     if not verification:
         raise HTTPException(404, "Код подтверждения не верен либо не найден")
     return verification[0]
 
 
-async def registration_confirm(data, db: AsyncSession):
-    verification = await get_verification_data(db, data)
-    verification_id = verification.id
-    user_id = verification.user_id
+async def consume_verification_code(db: AsyncSession, data, verification_types: tuple) -> int:
+    """
+    Проверяет и гасит код одним условным UPDATE ... RETURNING user_id.
+    Из параллельных подтверждений одного кода успешно только одно. Коммит - на вызывающем,
+    код в отдельном шарде гасится в своей транзакции.
+    После CODE_MAX_ATTEMPTS неверных попыток код отклоняется до запроса в БД
+    :param db:
+    :param data: code_id, code и phone_number либо email
+    :param verification_types:
+    :return: user_id
+    """
+    check_code_attempts(data.code_id)
+    shard_id, code_id = code_shard(data.code_id)
+    if shard_router.is_main(shard_id):
+        owner_id = contact_user_id_subquery(data)
+    else:
+        # users в основной БД: владелец контакта нужен до UPDATE в шарде
+        owner_id = (await get_contact_user(db, data)).id
+    async with shard_router.session(shard_id, db) as shard_db:
+        consumed = await shard_db.execute(update(VerificationCode)
+                                          .where(VerificationCode.id == code_id,
+                                                 VerificationCode.code == data.code,
+                                                 VerificationCode.user_id == owner_id,
+                                                 VerificationCode.verification_type.in_(verification_types),
+                                                 VerificationCode.is_active == True,
+                                                 VerificationCode.expires_at > datetime.utcnow())
+                                          .values(is_active=False)
+                                          .returning(VerificationCode.user_id)
+                                          .execution_options(synchronize_session=False))
+        user_id = consumed.scalar_one_or_none()
+        if user_id is None:
+            await reject_verification_code(db, shard_db, data, verification_types)
+    code_attempts.delete(data.code_id)
+    return user_id
+
+
+async def reject_verification_code(db: AsyncSession, shard_db: AsyncSession, data, verification_types: tuple):
+    """Только для неудачного подтверждения: определяет причину отказа, неверный код засчитывается в попытки"""
+    verification = await get_verification(db, shard_db, data, verification_types)
     if verification.expires_at < datetime.utcnow():
+        audit.record(verification.user_id, audit.CODE_FAILED, "expired")
         raise HTTPException(401, "Срок кода подтверждения истёк. Запросите новый")
 
     if verification.code != data.code:
+        await register_failed_attempts(db, [(data.code_id, verification.user_id)])
+        audit.record(verification.user_id, audit.CODE_FAILED, "wrong_code")
         raise HTTPException(401, "Код подтверждения неверный")
+    # Код погашен параллельным запросом
+    raise HTTPException(404, "Код подтверждения не верен либо не найден")
+
 
-    verification_update = await db.execute(update(VerificationCode)
-                                           .where(VerificationCode.id == verification_id)
-                                           .values(is_active=False))
+async def registration_confirm(data, db: AsyncSession):
+    contact = identity.contact_key(data)
+    user_id = await consume_verification_code(db, data, REGISTRATION_VERIFICATION_TYPES)
     user_active_update = await db.execute(update(User).where(User.id == user_id).values(is_active=True))
     refresh_token = await create_refresh_token(db, user_id)
     data = {
         "id": user_id,
-        "roles": ["user"]
+        "rm": rbac.role_bit(USER_ROLE_ID)
     }
     access_token = create_access_token(data)
-    response = RegistrationResponse(refresh_token=refresh_token, access_token=access_token).model_dump(mode="json")
-    role = UserRoles(user_id=user_id, role_id=1)
+    response = RegistrationResponse(refresh_token=refresh_token, access_token=access_token)
+    role = UserRoles(user_id=user_id, role_id=USER_ROLE_ID)
     db.add(role)
     await db.commit()
+    invalidate_user_cache(user_id)
+    identity.remember_active(contact, user_id)
+    audit.record(user_id, audit.LOGIN, "registration")
     return response
 
 
 
-async def auth_set_code(db: AsyncSession, user_id: int, auth_param: str):
+async def auth_set_code(db: AsyncSession, user_id: int, auth_param: str, data):
     """
     Запросить код
     :param db:
-    :param data:
+    :param user_id:
+    :param auth_param:
+    :param data: запрос с phone_number либо email
     :return:
     """
-    verification_code = await generate_security_code(db, user_id, VERIFICATION_TYPES[auth_param])
-    return AuthGetOutput(code_id=verification_code.id).model_dump(mode='json')
+    code_id = await generate_security_code(db, user_id, VERIFICATION_TYPES[auth_param], data)
+    return AuthGetOutput(code_id=code_id)
 
 
 
@@ -208,96 +496,199 @@ async def auth_get_code(db: AsyncSession, data):
     user_id = user.id
     if not user.is_active:
         raise HTTPException(401, "Пользователь не зарегистрирован. Пройдите регистрацию. Пожалуйста.")
-    return await auth_set_code(db, user_id, auth_param)
-
-
-async def get_verification_auth_data(db: AsyncSession, data):
-    if hasattr(data, 'phone_number'):
-        user = await get_user_by_phone(data.phone_number, db)
-    elif hasattr(data, 'email'):
-        user = await get_user_by_email(data.email, db)
-    else:
-        raise HTTPException(400, "Не переданы email или phone_number")
-
-    user_id = user.id
-    verification = await db.execute(select(VerificationCode).where(VerificationCode.id == data.code_id,
-                                                                   user_id == VerificationCode.user_id,
-                                                                   or_(
-                                                                       VerificationCode.verification_type ==
-                                                                       VERIFICATION_TYPES['auth_phone'],
-                                                                       VerificationCode.verification_type ==
-                                                                       VERIFICATION_TYPES['auth_email']
-                                                                   ),
-                                                                   VerificationCode.is_active==True).limit(1))
-    verification = verification.fetchone()
-    if not verification:
-        raise HTTPException(404, "Код подтверждения не верен либо не найден")
-    return verification[0]
-
-
-async def get_user_roles(db: AsyncSession, user_id: int) -> list:
-    user_roles_query = select(UserRoles.role_id).where(UserRoles.user_id == user_id)
-    user_roles_result = await db.execute(user_roles_query)
-    unique_role_ids = {role_id[0] for role_id in user_roles_result.fetchall()}
+    return await auth_set_code(db, user_id, auth_param, data)
 
-    if unique_role_ids:
-        roles_query = select(Role.name).where(Role.id.in_(unique_role_ids))
-        roles_result = await db.execute(roles_query)
 
-        unique_roles = {role[0] for role in roles_result.fetchall()}
+async def get_user_role_mask(db: AsyncSession, user_id: int) -> int:
+    """
+    Маска ролей пользователя (rbac). Считается по role_id, без чтения таблицы roles
+    :param db:
+    :param user_id:
+    :return:
+    """
+    role_ids = await db.scalars(select(UserRoles.role_id).where(UserRoles.user_id == user_id))
+    return rbac.mask_from_role_ids(role_ids.all())
 
-        return list(unique_roles)
 
-    return []
+async def get_users_role_masks(db: AsyncSession, user_ids) -> dict[int, int]:
+    """
+    Маски ролей нескольких пользователей одним запросом
+    :param db:
+    :param user_ids:
+    :return: {user_id: маска ролей}
+    """
+    roles_result = await db.execute(select(UserRoles.user_id, UserRoles.role_id)
+                                    .where(UserRoles.user_id.in_(set(user_ids))))
+    role_masks: dict[int, int] = {}
+    for user_id, role_id in roles_result.fetchall():
+        role_masks[user_id] = role_masks.get(user_id, 0) | rbac.role_bit(role_id)
+    return role_masks
 
 
 async def auth_confirm(db: AsyncSession, data):
-    verification = await get_verification_auth_data(db, data)
-    verification_id = verification.id
-    user_id = verification.user_id
-    user_roles = await get_user_roles(db, user_id)
-    if verification.expires_at < datetime.utcnow():
-        raise HTTPException(401, "Срок кода подтверждения истёк. Запросите новый")
-
-    if verification.code != data.code:
-        raise HTTPException(401, "Код подтверждения неверный")
-
-    verification_update = await db.execute(update(VerificationCode)
-                                           .where(VerificationCode.id == verification_id)
-                                           .values(is_active=False))
+    method = "phone" if hasattr(data, 'phone_number') else "email"
+    user_id = await consume_verification_code(db, data, AUTH_VERIFICATION_TYPES)
+    role_mask = await get_user_role_mask(db, user_id)
     #user_active_update = await db.execute(update(User).where(User.id == user_id).values(is_active=True))
     refresh_token = await create_refresh_token(db, user_id)
     data = {
         "id": user_id,
-        "roles": user_roles
+        "rm": role_mask
     }
     access_token = create_access_token(data)
-    response = AuthOutput(refresh_token=refresh_token, access_token=access_token).model_dump(mode="json")
+    response = AuthOutput(refresh_token=refresh_token, access_token=access_token)
     await db.commit()
+    audit.record(user_id, audit.LOGIN, method)
     return response
 
 
-async def change_token(db: AsyncSession, data: ChangeToken):
-    token = await db.execute(select(RefreshToken).where(RefreshToken.token == data.refresh_token).limit(1))
-    token = token.fetchone()
-    if not token:
+async def revoke_token_family(db: AsyncSession, family_id: str):
+    """
+    Отзывает все активные токены семьи одним UPDATE
+    :param db:
+    :param family_id:
+    :return:
+    """
+    await db.execute(update(RefreshToken)
+                     .where(RefreshToken.family_id == family_id, RefreshToken.is_active == True)
+                     .values(is_active=False)
+                     .execution_options(synchronize_session=False))
+
+
+async def revoke_user_tokens(db: AsyncSession, user_id: int):
+    """
+    Выход со всех устройств. UPDATE идет по индексу (user_id, is_active) в шарде пользователя,
+    при DATABASE_SHARD_URLS - и в основной БД, где остались токены, выпущенные до шардирования
+    :param db:
+    :param user_id:
+    :return:
+    """
+    revoke = (update(RefreshToken)
+              .where(RefreshToken.user_id == user_id, RefreshToken.is_active == True)
+              .values(is_active=False)
+              .execution_options(synchronize_session=False))
+    async with shard_router.session_for_user(user_id, db) as shard_db:
+        await shard_db.execute(revoke)
+    if shard_router.sharded:
+        await db.execute(revoke)
+    await db.commit()
+    return SuccessResponse()
+
+
+async def reject_refresh_token(db: AsyncSession, refresh_token: str):
+    """
+    Вызывается, когда токен не удалось ротировать. Определяет причину,
+    при повторном использовании деактивированного токена отзывает всю семью
+    :param db:
+    :param refresh_token:
+    :return:
+    """
+    token = await db.scalar(select(RefreshToken)
+                            .where(RefreshToken.token_hash == hash_refresh_token(refresh_token)).limit(1))
+    if token is None:
         raise HTTPException(401, "Токен не найден")
-    token = token[0]
-    user_id = token.user_id
-    if token.expires_at < datetime.utcnow():
-        raise HTTPException(401, "Refresh token истёк. Получите новый")
+    if not token.is_active:
+        await revoke_token_family(db, token.family_id)
+        await db.commit()
+        raise HTTPException(401, "Refresh token уже использован. Все сессии этого входа отозваны")
+    raise HTTPException(401, "Refresh token истёк. Получите новый")
+
 
-    user_roles = await get_user_roles(db, user_id)
+async def change_token(db: AsyncSession, data: ChangeToken):
+    """
+    Ротация refresh токена: старый деактивируется условным UPDATE ... RETURNING
+    (одновременно поиск по уникальному индексу и защита от гонки), новый выпускается в той же семье.
+    Токен ищется в шарде из его префикса, семья не покидает свою БД
+    :param db:
+    :param data:
+    :return:
+    """
+    try:
+        shard_id = refresh_token_shard(data.refresh_token)
+    except ValueError:
+        raise HTTPException(401, "Токен не найден")
+    async with shard_router.session(shard_id, db) as shard_db:
+        rotated = await shard_db.execute(update(RefreshToken)
+                                         .where(RefreshToken.token_hash == hash_refresh_token(data.refresh_token),
+                                                RefreshToken.is_active == True,
+                                                RefreshToken.expires_at > datetime.utcnow())
+                                         .values(is_active=False)
+                                         .returning(RefreshToken.user_id, RefreshToken.family_id)
+                                         .execution_options(synchronize_session=False))
+        rotated = rotated.fetchone()
+        if not rotated:
+            await reject_refresh_token(shard_db, data.refresh_token)
+        user_id, family_id = rotated
+        refresh_token = await issue_refresh_token(shard_db, user_id, shard_id, family_id)
+
+    role_mask = await get_user_role_mask(db, user_id)
     data = {
         "id": user_id,
-        "roles": user_roles
+        "rm": role_mask
     }
     access_token = create_access_token(data)
-    return JSONResponse(ChangeTokenOutput(access_token=access_token).model_dump(mode='json'))
+    audit.record(user_id, audit.REFRESH)
+    return ChangeTokenOutput(access_token=access_token, refresh_token=refresh_token)
+
+
+def introspect_access_token(token: str):
+    """
+    Проверяет подпись access токена. Claims возвращаются и для истёкшего токена
+    :param token:
+    :return: TokenIntrospection либо None, если это не JWT
+    """
+    try:
+        claims = decode_jwt_token(token, verify_exp=False)
+    except jwt.JWTError:
+        return None
+    exp = claims.get("exp")
+    expired = exp is None or exp <= time.time()
+    return TokenIntrospection(active=not expired, expired=expired, token_type="access_token",
+                              user_id=claims.get("id"), roles=rbac.role_names(rbac.token_mask(claims)), exp=exp)
+
+
+async def introspect_tokens(db: AsyncSession, data: IntrospectRequest):
+    """
+    Пакетная проверка токенов. Access токены проверяются локально,
+    refresh токены ищутся одним IN-запросом на шард
+    :param db:
+    :param data:
+    :return: IntrospectOutput
+    """
+    results: list = [None] * len(data.tokens)
+    refresh_positions: dict[bytes, list[int]] = {}
+    shard_hashes: dict[Optional[int], list[bytes]] = {}
+    for position, item in enumerate(data.tokens):
+        if item.token_type_hint != "refresh_token":
+            results[position] = introspect_access_token(item.token)
+        if results[position] is None and item.token_type_hint != "access_token":
+            try:
+                shard_id = refresh_token_shard(item.token)
+            except ValueError:
+                continue
+            token_hash = hash_refresh_token(item.token)
+            if token_hash not in refresh_positions:
+                shard_hashes.setdefault(shard_id, []).append(token_hash)
+            refresh_positions.setdefault(token_hash, []).append(position)
+
+    now = datetime.utcnow()
+    for shard_id, hashes in shard_hashes.items():
+        async with shard_router.session(shard_id, db) as shard_db:
+            tokens = await shard_db.scalars(select(RefreshToken).where(RefreshToken.token_hash.in_(hashes)))
+            tokens = tokens.all()
+        for token in tokens:
+            expired = token.expires_at < now
+            info = TokenIntrospection(active=token.is_active and not expired, expired=expired,
+                                      token_type="refresh_token", user_id=token.user_id,
+                                      exp=calendar.timegm(token.expires_at.utctimetuple()))
+            for position in refresh_positions[token.token_hash]:
+                results[position] = info
+
+    return IntrospectOutput(tokens=[info or TokenIntrospection(active=False) for info in results])
 
 
 async def auth_telegram_get_code(db: AsyncSession, data):
-    if data.password != os.getenv("KOSTYA"):
+    if data.password != get_settings().KOSTYA:
         raise HTTPException(401, "Key is not valid")
     if hasattr(data, 'phone_number'):
         auth_param = "auth_phone"
@@ -311,50 +702,255 @@ async def auth_telegram_get_code(db: AsyncSession, data):
     user_id = user.id
     if not user.is_active:
         raise HTTPException(401, "Пользователь не зарегистрирован. Пройдите регистрацию. Пожалуйста.")
-    return await auth_set_code(db, user_id, auth_param)
+    return await auth_set_code(db, user_id, auth_param, data)
 
 
 async def auth_telegram_confirm(db: AsyncSession, data):
-    if data.password != os.getenv("KOSTYA"):
+    if data.password != get_settings().KOSTYA:
         raise HTTPException(401, "Key is not valid")
 
-    verification = await get_verification_auth_data(db, data)
-    verification_id = verification.id
-    user_id = verification.user_id
-    user_roles = await get_user_roles(db, user_id)
-    if verification.expires_at < datetime.utcnow():
-        raise HTTPException(401, "Срок кода подтверждения истёк. Запросите новый")
-
-    if verification.code != data.code:
-        raise HTTPException(401, "Код подтверждения неверный")
-
-    verification_update = await db.execute(update(VerificationCode)
-                                           .where(VerificationCode.id == verification_id)
-                                           .values(is_active=False))
+    telegram_id = data.telegram_id
+    user_id = await consume_verification_code(db, data, AUTH_VERIFICATION_TYPES)
+    role_mask = await get_user_role_mask(db, user_id)
+    if telegram_id is not None:
+        await link_telegram_id(db, user_id, telegram_id)
     #refresh_token = await create_refresh_token(db, user_id)
     data = {
         "id": user_id,
-        "roles": user_roles
+        "rm": role_mask
     }
-    access_token = create_access_token(data, timedelta(days=365*30))
-    response = AuthOutput(refresh_token="", access_token=access_token).model_dump(mode="json")
+    access_token = create_access_token(data, TELEGRAM_ACCESS_TOKEN_EXPIRE)
+    response = AuthOutput(refresh_token="", access_token=access_token)
     await db.commit()
+    if telegram_id is not None:
+        telegram_users.set(telegram_id, user_id)
+    audit.record(user_id, audit.LOGIN, "telegram")
     return response
 
 
-async def users_me(db: AsyncSession, user_id: int):
+async def link_telegram_id(db: AsyncSession, user_id: int, telegram_id: int):
+    """
+    Привязывает telegram_id к пользователю, отвязывая его от предыдущего владельца. Коммит - на вызывающем
+    :param db:
+    :param user_id:
+    :param telegram_id:
+    :return:
+    """
+    previous_owners = await db.scalars(update(User)
+                                       .where(User.telegram_id == telegram_id, User.id != user_id)
+                                       .values(telegram_id=None)
+                                       .returning(User.id)
+                                       .execution_options(synchronize_session=False))
+    await db.execute(update(User).where(User.id == user_id).values(telegram_id=telegram_id))
+    telegram_users.delete(telegram_id)
+    for previous_owner in previous_owners.all():
+        invalidate_user_cache(previous_owner)
+    invalidate_user_cache(user_id)
+
+
+async def get_user_id_by_telegram_id(db: AsyncSession, telegram_id: int) -> int:
+    """
+    Точечный поиск по уникальному индексу telegram_id, результат кэшируется в памяти
+    :param db:
+    :param telegram_id:
+    :return: user_id
+    """
+    user_id = telegram_users.get(telegram_id)
+    if user_id is not None:
+        return user_id
+    user = await db.execute(select(User.id, User.is_active).where(User.telegram_id == telegram_id))
+    user = user.fetchone()
+    if not user:
+        raise HTTPException(404, "Telegram не привязан. Авторизуйтесь по телефону или email")
+    if not user.is_active:
+        raise HTTPException(401, "Пользователь не зарегистрирован. Пройдите регистрацию. Пожалуйста.")
+    telegram_users.set(telegram_id, user.id)
+    return user.id
+
+
+async def get_telegram_user_role_mask(db: AsyncSession, user_id: int, telegram_id: int) -> Optional[int]:
+    """
+    Маска ролей пользователя, если telegram_id все еще привязан к нему: привязка проверяется
+    тем же запросом, что читает роли
+    :param db:
+    :param user_id: user_id из telegram_users
+    :param telegram_id:
+    :return: None - telegram_id привязан к другому пользователю либо отвязан
+    """
+    rows = await db.execute(select(UserRoles.role_id)
+                            .select_from(User)
+                            .outerjoin(UserRoles, UserRoles.user_id == User.id)
+                            .where(User.id == user_id, User.telegram_id == telegram_id))
+    rows = rows.all()
+    if not rows:
+        return None
+    return rbac.mask_from_role_ids(role_id for role_id, in rows if role_id is not None)
+
+
+async def auth_telegram_login(db: AsyncSession, data: AuthTelegramLogin):
+    """Вход бота по привязанному telegram_id без кода подтверждения"""
+    if data.password != get_settings().KOSTYA:
+        raise HTTPException(401, "Key is not valid")
+    user_id = await get_user_id_by_telegram_id(db, data.telegram_id)
+    role_mask = await get_telegram_user_role_mask(db, user_id, data.telegram_id)
+    if role_mask is None:
+        # Запись кэша устарела: telegram_id перепривязан в соседнем воркере
+        telegram_users.delete(data.telegram_id)
+        user_id = await get_user_id_by_telegram_id(db, data.telegram_id)
+        role_mask = await get_user_role_mask(db, user_id)
+    data = {
+        "id": user_id,
+        "rm": role_mask
+    }
+    access_token = create_access_token(data, TELEGRAM_ACCESS_TOKEN_EXPIRE)
+    audit.record(user_id, audit.LOGIN, "telegram_id")
+    return AuthOutput(refresh_token="", access_token=access_token)
+
+
+async def auth_telegram_batch_confirm(db: AsyncSession, data: AuthTelegramBatchConfirm):
+    """
+    Пакетная авторизация бота: пользователи ищутся одним IN-запросом, коды - одним на шард,
+    использованные коды гасятся одним UPDATE на шард. Ошибка одного элемента не влияет на остальные
+    :param db:
+    :param data:
+    :return: AuthTelegramBatchOutput
+    """
+    if data.password != get_settings().KOSTYA:
+        raise HTTPException(401, "Key is not valid")
+
+    phones = {item.phone_number for item in data.items if item.phone_number}
+    emails = {item.email for item in data.items if item.email}
+    users = await db.scalars(select(User)
+                             .where(or_(User.phone_number.in_(phones), User.email.in_(emails))))
+    users_by_phone, users_by_email = {}, {}
+    for user in users.all():
+        if user.phone_number in phones:
+            users_by_phone[user.phone_number] = user.id
+        if user.email in emails:
+            users_by_email[user.email] = user.id
+
+    codes = {}
+    for shard_id, code_ids in shard_router.split_ids({item.code_id for item in data.items}).items():
+        async with shard_router.session(shard_id, db) as shard_db:
+            shard_codes = await shard_db.scalars(select(VerificationCode)
+                                                 .where(VerificationCode.id.in_(code_ids),
+                                                        VerificationCode.verification_type.in_(
+                                                            AUTH_VERIFICATION_TYPES),
+                                                        VerificationCode.is_active == True))
+            codes.update((shard_router.global_id(shard_id, code.id), code) for code in shard_codes.all())
+
+    now = datetime.utcnow()
+    errors: list = [None] * len(data.items)
+    item_users: list = [None] * len(data.items)
+    failed_codes = []
+    max_attempts = get_settings().CODE_MAX_ATTEMPTS
+    for position, item in enumerate(data.items):
+        if code_attempts.get(item.code_id, 0) >= max_attempts:
+            errors[position] = CODE_LOCKED_ERROR
+            continue
+        if item.phone_number:
+            user_id = users_by_phone.get(item.phone_number)
+        elif item.email:
+            user_id = users_by_email.get(item.email)
+        else:
+            errors[position] = "Не переданы email или phone_number"
+            continue
+        code = codes.get(item.code_id)
+        if user_id is None:
+            errors[position] = "Пользователь не зарегистрирован"
+        elif code is None or code.user_id != user_id:
+            errors[position] = "Код подтверждения не верен либо не найден"
+        elif code.expires_at < now:
+            errors[position] = "Срок кода подтверждения истёк. Запросите новый"
+        elif code.code != item.code:
+            errors[position] = "Код подтверждения неверный"
+            failed_codes.append((item.code_id, user_id))
+            audit.record(user_id, audit.CODE_FAILED, "wrong_code")
+        else:
+            item_users[position] = user_id
+    await register_failed_attempts(db, failed_codes)
+
+    used_codes = set()
+    for shard_id, code_ids in shard_router.split_ids({item.code_id for item, user_id in zip(data.items, item_users)
+                                                      if user_id is not None}).items():
+        # RETURNING отсекает коды, погашенные параллельным запросом после нашего SELECT
+        async with shard_router.session(shard_id, db) as shard_db:
+            shard_used = await shard_db.scalars(update(VerificationCode)
+                                                .where(VerificationCode.id.in_(code_ids),
+                                                       VerificationCode.is_active == True)
+                                                .values(is_active=False)
+                                                .returning(VerificationCode.id)
+                                                .execution_options(synchronize_session=False))
+            used_codes.update(shard_router.global_id(shard_id, code_id) for code_id in shard_used.all())
+            await shard_db.commit()
+
+    role_masks = await get_users_role_masks(db, {user_id for user_id in item_users if user_id is not None})
+    results = []
+    claimed_codes = set()
+    for item, user_id, error in zip(data.items, item_users, errors):
+        if user_id is not None and (item.code_id not in used_codes or item.code_id in claimed_codes):
+            user_id, error = None, "Код подтверждения не верен либо не найден"
+        if user_id is None:
+            results.append(AuthTelegramBatchItemOutput(status=False, error=error))
+            continue
+        claimed_codes.add(item.code_id)
+        audit.record(user_id, audit.LOGIN, "telegram")
+        access_token = create_access_token({"id": user_id, "rm": role_masks.get(user_id, 0)},
+                                           TELEGRAM_ACCESS_TOKEN_EXPIRE)
+        results.append(AuthTelegramBatchItemOutput(status=True, access_token=access_token))
+    return AuthTelegramBatchOutput(results=results)
+
+
+def invalidate_user_cache(user_id: int):
+    """Вызывается после любого изменения строки users"""
+    users_me_cache.delete(user_id)
+
+
+def etag_matches(etag: str, if_none_match: str = None) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+async def users_me(db: AsyncSession, user_id: int, if_none_match: str = None):
+    """
+    Профиль из кэша сериализованных ответов, в БД идет только промах.
+    Совпадение If-None-Match с ETag отдает 304 без тела
+    :param db:
+    :param user_id:
+    :param if_none_match: заголовок If-None-Match
+    :return: Response
+    """
+    cached = users_me_cache.get(user_id)
+    if cached is None:
+        cached = await users_me_loads.do(user_id, lambda: load_users_me(db, user_id))
+
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def load_users_me(db: AsyncSession, user_id: int) -> tuple[bytes, str]:
+    """Промах users_me_cache: сериализует профиль и кладет в кэш вместе с ETag"""
     user = await db.execute(select(User).where(User.id == user_id).limit(1))
     user = user.scalar_one()
-    return JSONResponse(content=UserOutput.model_validate(user).model_dump(mode='json'))
+    body = UserOutput.model_validate(user).model_dump_json().encode()
+    cached = (body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"')
+    users_me_cache.set(user_id, cached)
+    return cached
 
 
 async def get_qr_code_info(db: AsyncSession):
     token = QRCodeGenerator().hash
-    url = os.getenv("AUTH_SERVER") + "qr_code/auth/" + token
+    url = get_settings().AUTH_SERVER + "qr_code/auth/" + token
     qr_auth = QRAuthTokens(expires_at=datetime.utcnow() + timedelta(minutes=5), url=url, token=token)
     db.add(qr_auth)
     await db.commit()
-    return JSONResponse(content=GetQROutput.model_validate(qr_auth).model_dump(mode='json'))
+    return GetQROutput.model_validate(qr_auth)
 
 
 async def qr_code_auth(db: AsyncSession, user_id: int, hashed: str):
@@ -369,7 +965,8 @@ async def qr_code_auth(db: AsyncSession, user_id: int, hashed: str):
     verify_qr_token.user_id = user_id
     await db.commit()
     await db.refresh(verify_qr_token)
-    return JSONResponse(content=SuccessResponse().model_dump(mode='json'))
+    audit.record(user_id, audit.QR_APPROVE)
+    return SuccessResponse()
 
 
 async def qr_longpoll(db: AsyncSession, hashed: str):
@@ -381,33 +978,99 @@ async def qr_longpoll(db: AsyncSession, hashed: str):
 
     if qr.user_id is not None:
         raise HTTPException(401, "Странная ошибка")
+    # Завершение транзакции возвращает соединение в пул на время ожидания
+    await db.commit()
     start_time = datetime.utcnow()
     expiration_time = start_time + timedelta(minutes=5)
     while True:
-        async with db_manager.connect() as new_connection:
-            await asyncio.sleep(1)
-            qr_code = await new_connection.execute(select(QRAuthTokens).where(QRAuthTokens.token == hashed).limit(1))
-            qr_code = qr_code.fetchone()
-            if qr_code is None:
-                raise HTTPException(401, "Ошибка: QR код не найден")
-
-            if qr_code.user_id is not None:
-                user_id = qr_code.user_id
-                user_roles = await get_user_roles(db, user_id)
-                refresh_token = await create_refresh_token(db, user_id)
-                data = {
-                    "id": user_id,
-                    "roles": user_roles
-                }
-                access_token = create_access_token(data)
-                response = AuthOutput(refresh_token=refresh_token, access_token=access_token).model_dump(mode="json")
-                qr_token = await db.execute(select(QRAuthTokens).where(QRAuthTokens.token == hashed).limit(1))
-                qr = qr_token.scalar_one_or_none()
-                qr.expires_at = datetime.utcnow()
-                await db.commit()
-                return response
+        await asyncio.sleep(1)
+        qr_code = await qr_polls.do(hashed, lambda: poll_qr_token(hashed))
+        if qr_code is None:
+            raise HTTPException(401, "Ошибка: QR код не найден")
+
+        if qr_code.user_id is not None:
+            user_id = qr_code.user_id
+            role_mask = await get_user_role_mask(db, user_id)
+            refresh_token = await create_refresh_token(db, user_id)
+            data = {
+                "id": user_id,
+                "rm": role_mask
+            }
+            access_token = create_access_token(data)
+            response = AuthOutput(refresh_token=refresh_token, access_token=access_token)
+            qr_token = await db.execute(select(QRAuthTokens).where(QRAuthTokens.token == hashed).limit(1))
+            qr = qr_token.scalar_one_or_none()
+            qr.expires_at = datetime.utcnow()
+            await db.commit()
+            return response
         if datetime.utcnow() >= expiration_time:
             raise HTTPException(408, "Ошибка: Время ожидания истекло")
 
 
+async def poll_qr_token(hashed: str):
+    """Один опрос QR на отдельном соединении: соединение не держится во время ожидания между опросами"""
+    async with qr_poll_slots, db_manager.connect() as connection:
+        qr_code = await connection.execute(select(QRAuthTokens.user_id).where(QRAuthTokens.token == hashed).limit(1))
+        return qr_code.fetchone()
+
+
+async def upload_file(db: AsyncSession, user_id: int, name: str, content_type: str, chunks: AsyncIterator[bytes]):
+    """
+    Сохраняет тело запроса потоком, не загружая файл в память
+    :param db:
+    :param user_id:
+    :param name: имя файла
+    :param content_type:
+    :param chunks: request.stream()
+    :return: FileOutput
+    """
+    file_hash, path, size = await store_stream(chunks, get_settings().FILES_MAX_SIZE)
+    file = File(name=name, user_id=user_id, hash=file_hash, path=path, type=content_type, size=size)
+    db.add(file)
+    await db.commit()
+    return FileOutput.model_validate(file)
+
+
+async def get_user_file(db: AsyncSession, user_id: int, file_id: int) -> File:
+    file = await db.scalar(select(File).where(File.id == file_id, File.user_id == user_id, File.is_active == True))
+    if file is None:
+        raise HTTPException(404, "Файл не найден")
+    return file
+
+
+async def list_files(db: AsyncSession, user_id: int, after_id: int = 0, limit: int = 100):
+    """Активные файлы пользователя, keyset-пагинация по индексу (user_id, is_active)"""
+    files = await db.scalars(select(File)
+                             .where(File.user_id == user_id, File.is_active == True, File.id > after_id)
+                             .order_by(File.id)
+                             .limit(limit))
+    files = [FileOutput.model_validate(file) for file in files.all()]
+    next_after_id = files[-1].id if len(files) == limit else None
+    return FilesPageOutput(files=files, next_after_id=next_after_id)
 
+
+async def download_file(db: AsyncSession, user_id: int, file_id: int, range_header: str = None,
+                        if_none_match: str = None):
+    """
+    Отдает файл без чтения в память, с поддержкой Range. ETag - hash содержимого
+    :param db:
+    :param user_id:
+    :param file_id:
+    :param range_header:
+    :param if_none_match:
+    :return:
+    """
+    file = await get_user_file(db, user_id, file_id)
+    etag = '"' + file.hash + '"'
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return RangeFileResponse(file.path, file.size, parse_range(range_header, file.size),
+                             media_type=file.type, filename=file.name, headers={"ETag": etag})
+
+
+async def delete_file(db: AsyncSession, user_id: int, file_id: int):
+    """Скрывает файл. Блоб остается: на него могут ссылаться другие строки с тем же hash"""
+    file = await get_user_file(db, user_id, file_id)
+    file.is_active = False
+    await db.commit()
+    return SuccessResponse()
@@ -1,32 +1,22 @@
 import asyncio
+import hashlib
 import os
+import secrets
 import uuid
 from datetime import timedelta, datetime
+from typing import Optional
 
-import requests_async
-from PIL import Image
-
-from dotenv import load_dotenv
 from fastapi import HTTPException
 from jose import jwt
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-
-
-from qrcode_styled import QRCodeStyled, ERROR_CORRECT_Q
-
+from config import get_settings
+from orm import shard_router
 from src.models import RefreshToken
 
-load_dotenv()
-
 ACCESS_TOKEN_EXPIRE_MINUTES = 15
 REFRESH_TOKEN_EXPIRE_DAYS = 7
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-
-
-load_dotenv()
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -39,25 +29,78 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    settings = get_settings()
+    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
 
-async def create_refresh_token(db: AsyncSession, user_id: int):
+def hash_refresh_token(token: str) -> bytes:
+    """
+    sha256 refresh токена. В БД хранится и ищется только он
+    :param token:
+    :return: 32 байта
+    """
+    return hashlib.sha256(token.encode()).digest()
+
+
+def refresh_token_shard(token: str) -> Optional[int]:
+    """
+    Шард refresh токена по префиксу "<shard_id>.". Токен без префикса выпущен до шардирования
+    и лежит в основной БД
+    :param token:
+    :return: номер шарда, None - основная БД
+    :raise ValueError: префикс не указывает на существующий шард
+    """
+    prefix, separator, _ = token.partition(".")
+    if not separator:
+        return None
+    if not prefix.isdigit() or not shard_router.has_shard(int(prefix)):
+        raise ValueError("Unknown refresh token shard")
+    return int(prefix)
+
+
+async def issue_refresh_token(db: AsyncSession, user_id: int, shard_id: Optional[int], family_id: str = None):
     """
-    Создает refresh токен
-    :param db:
+    Выпускает refresh токен в сессии шарда db
+    :param db: сессия шарда shard_id
     :param user_id:
+    :param shard_id: шард токена, попадает в префикс. None - основная БД, токен без префикса
+    :param family_id: семья токенов. None - новая сессия, новая семья
     :return:
     """
     expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    token = str(uuid.uuid4())
-    refresh_token = RefreshToken(user_id=user_id, token=token, expires_at=expire)
+    token = secrets.token_urlsafe(32)
+    if shard_id is not None:
+        token = f"{shard_id}.{token}"
+    refresh_token = RefreshToken(user_id=user_id, token_hash=hash_refresh_token(token), expires_at=expire,
+                                 family_id=family_id or str(uuid.uuid4()))
     db.add(refresh_token)
     await db.commit()
-    await db.refresh(refresh_token)
     return token
 
 
+async def create_refresh_token(db: AsyncSession, user_id: int):
+    """
+    Создает refresh токен новой семьи в шарде пользователя
+    :param db: сессия основной БД, используется, если шардов нет
+    :param user_id:
+    :return:
+    """
+    shard_id = shard_router.shard_id_for_user(user_id)
+    async with shard_router.session(shard_id, db) as shard_db:
+        return await issue_refresh_token(shard_db, user_id, shard_id)
+
+
+def decode_jwt_token(token: str, verify_exp: bool = True) -> dict:
+    """
+    Декодирует access токен и проверяет подпись. Исключения jose пробрасываются как есть
+    :param token:
+    :param verify_exp: False - вернуть claims и истёкшего токена
+    :return:
+    """
+    settings = get_settings()
+    return jwt.decode(token, settings.SECRET_KEY, algorithms=settings.ALGORITHM, options={"verify_exp": verify_exp})
+
+
 async def verify_jwt_token(token):
     """
     Проверяет токен, возвращает данные из него
@@ -66,7 +109,7 @@ async def verify_jwt_token(token):
     """
     token = token.credentials
     try:
-        decoded_token = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHM)
+        decoded_token = decode_jwt_token(token)
         expiration_time = decoded_token.get("exp")
         if expiration_time:
             current_time = datetime.utcnow()
@@ -90,45 +133,19 @@ class QRCodeGenerator:
         return self.hash[:length]
 
     async def generate_styled_qr(self, output_filename=None, image_path=None, lossless=True, quality=100, method=4, fill_color=None, background_color='black'):
-        qr = QRCodeStyled(border=2)
-        qr.error_correction = ERROR_CORRECT_Q
-        image = None
-        if image_path:
-            image = Image.open(image_path)
-
-        img = qr.get_image(self.hash, image=image)
-
-        img.fill_color = fill_color
-        img.back_color = background_color
+        from src import qr_image
 
         self.output_filename = f'qr_{uuid.uuid4()}.png'
-        os.makedirs(os.getenv("QRCODES_PATH"), exist_ok=True)
-        with open(os.path.join(os.getenv("QRCODES_PATH"), self.output_filename), 'wb') as stream:
-            img.save(stream, 'PNG', lossless=lossless, quality=quality)
+        qr_image.render_styled_qr(self.hash, self._output_path(), image_path=image_path, lossless=lossless,
+                                  quality=quality, fill_color=fill_color, background_color=background_color)
 
         result = await self.upload_photo()
         return result
 
-
+    def _output_path(self):
+        return os.path.join(get_settings().QRCODES_PATH, self.output_filename)
 
     async def upload_photo(self):
-        token = os.getenv("ADMIN")
-        url = 'http://s33.enotgpt.ru/upload/photo'
-        headers = {
-            'accept': 'application/json',
-            'Authorization': f'Bearer {token}',
-        }
-
-        file_name = self.output_filename
-        path = os.path.join(os.getenv("QRCODES_PATH"), file_name)
-        with open(path, 'rb') as file:
-            files = {'file': (file_name, file, 'image/png')}
-            response = await requests_async.post(url, headers=headers, files=files)
-
-        print(response.json())
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise HTTPException(403, "Error create qr code: " + response.text)
-
+        from src import qr_image
 
+        return await qr_image.upload_photo(self._output_path())